@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmarks.
+Each workload is a small synthetic program, assembled here so runs are reproducible, or 'replay', which runs a real
+challenge binary on a walkthrough script (or just up to its first prompt without one) if the binary is around. Every (workload, engine) pair runs in a fresh interpreter, which reports:
+    'instructions': how many instructions the workload executes
+    'seconds': time spent executing them
+    'ips': instructions per second
+    'startup': seconds from launching the interpreter to the first instruction, imports and loading included
+    'peak_rss_kb': peak resident memory of the process
+There is also a microbenchmark of single instructions, timing the generic handlers against operand specialised ones.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from vm import (DecodeCache, HALT, Stop, handlers, op_table, param_lens, batch_size, load_memory, load_program,
+                  run_batch, run_inner)
+from headless import ScriptedInput
+from specialized import handler_for
+
+# Engines a workload can run on. 'inner' steps vm.run_inner one instruction at a time, the way the slow path does.
+engines = ['inner', 'batch', 'jit']
+opcodes = {name: op for op, name in op_table.items()}
+# Instructions the microbenchmark times, covering the operand shapes that matter.
+micro_cases = [('set', 'r0', 'r1'), ('set', 'r0', 7), ('add', 'r0', 'r1', 'r2'), ('add', 'r0', 'r1', 5), ('add', 'r0', 3, 4),
+               ('mult', 'r0', 'r1', 'r2'), ('mod', 'r0', 'r1', 7), ('and', 'r0', 'r1', 'r2'), ('eq', 'r3', 'r0', 5),
+               ('gt', 'r3', 'r0', 'r1'), ('not', 'r0', 'r1'), ('jt', 'r0', 100), ('jf', 'r0', 'r1'), ('push', 'r0'),
+               ('rmem', 'r0', 'r1'), ('wmem', 200, 'r0'), ('call', 'r1'), ('out', 65)]
+
+
+def assemble(source):
+    """
+    Turns a list of instructions into words. An instruction is a tuple of op name and operands, where an operand is
+    a number, a register 'r0'-'r7', or a label, optionally plus a number as in 'label+3'. A bare string defines a label
+    at that point, and a list is raw data.
+    """
+    labels = {}
+    address = 0
+    for item in source:
+        if isinstance(item, str):
+            labels[item] = address
+        elif isinstance(item, list):
+            address += len(item)
+        else:
+            address += 1 + param_lens[opcodes[item[0]]]
+
+    def operand(value):
+        if isinstance(value, int):
+            return value
+        if len(value) == 2 and value[0] == 'r' and value[1].isdigit():
+            return 32768 + int(value[1])
+        label, _, extra = value.partition('+')
+        return labels[label] + int(extra or 0)
+    words = []
+    for item in source:
+        if isinstance(item, list):
+            words += item
+        elif not isinstance(item, str):
+            words.append(opcodes[item[0]])
+            words += [operand(x) for x in item[1:]]
+    return words
+
+
+def arithmetic(scale):
+    """
+    Tight loop over the arithmetic, logic, comparison and branch ops.
+    """
+    return assemble([
+        ('set', 'r4', scale),
+        'outer',
+        ('set', 'r0', 10000),
+        'loop',
+        ('add', 'r0', 'r0', 32767),
+        ('and', 'r1', 'r0', 255), ('or', 'r2', 'r1', 3), ('not', 'r3', 'r2'),
+        ('mult', 'r6', 'r0', 3), ('mod', 'r6', 'r6', 7),
+        ('eq', 'r7', 'r6', 2), ('gt', 'r7', 'r6', 2), ('jf', 'r7', 'skip'),
+        ('noop',),
+        'skip',
+        ('jt', 'r0', 'loop'),
+        ('add', 'r4', 'r4', 32767), ('jt', 'r4', 'outer'),
+        ('halt',),
+    ])
+
+
+def recursion(scale):
+    """
+    Naive recursive Fibonacci, counting leaves in r2, so nearly everything is call, ret, push and pop.
+    """
+    return assemble([
+        ('set', 'r4', scale),
+        'outer',
+        ('set', 'r0', 20), ('call', 'fib'),
+        ('add', 'r4', 'r4', 32767), ('jt', 'r4', 'outer'),
+        ('halt',),
+        'fib',
+        ('gt', 'r1', 'r0', 1), ('jt', 'r1', 'body'),
+        ('add', 'r2', 'r2', 1), ('ret',),
+        'body',
+        ('push', 'r0'), ('add', 'r0', 'r0', 32767), ('call', 'fib'), ('pop', 'r0'),
+        ('push', 'r0'), ('add', 'r0', 'r0', 32766), ('call', 'fib'), ('pop', 'r0'),
+        ('ret',),
+    ])
+
+
+def self_modifying(scale):
+    """
+    Loop that rewrites the immediate operand of an instruction it's about to run, so every pass invalidates code.
+    """
+    return assemble([
+        ('set', 'r4', scale),
+        'outer',
+        ('set', 'r0', 16000),
+        'loop',
+        ('add', 'r0', 'r0', 32767),
+        ('and', 'r3', 'r0', 1023),
+        ('wmem', 'patch+3', 'r3'),
+        ('rmem', 'r5', 'patch+3'),
+        'patch',
+        ('add', 'r1', 'r1', 0),
+        ('jt', 'r0', 'loop'),
+        ('add', 'r4', 'r4', 32767), ('jt', 'r4', 'outer'),
+        ('halt',),
+    ])
+
+
+def output_heavy(scale):
+    """
+    Prints a zero terminated string out of memory a character at a time, then a fixed banner of immediate 'out's.
+    """
+    text = "You are standing in a twisty maze of little benchmarks, all alike.\n"
+    banner = "== benchmark ==\n"
+    return assemble([
+        ('set', 'r4', scale * 300),
+        'outer',
+        ('set', 'r1', 'text'),
+        'loop',
+        ('rmem', 'r2', 'r1'), ('jf', 'r2', 'done'),
+        ('out', 'r2'), ('add', 'r1', 'r1', 1), ('jmp', 'loop'),
+        'done',
+    ] + [('out', ord(c)) for c in banner] + [
+        ('add', 'r4', 'r4', 32767), ('jt', 'r4', 'outer'),
+        ('halt',),
+        'text',
+        [ord(c) for c in text] + [0],
+    ])
+
+
+workloads = {'arithmetic': arithmetic, 'recursion': recursion, 'self_modifying': self_modifying,
+             'output_heavy': output_heavy}
+
+
+def prepare(name, scale, challenge=None, script=None):
+    """
+    Returns the memory and scripted input for a workload.
+    """
+    if name == 'replay':
+        lines = []
+        if script:
+            with open(script) as f:
+                lines = f.readlines()
+        return load_program(challenge), ScriptedInput(lines)
+    return load_memory(workloads[name](scale)), ScriptedInput([])
+
+
+def count_instructions(memory, stdin, stdout):
+    """
+    Runs a workload to the end, counting instructions, for the engines that don't keep count themselves.
+    """
+    decoded = DecodeCache(memory, stdin, stdout)
+    # Fused runs would count as one.
+    decoded.fuse = False
+    stack = []
+    registers = [0] * 8
+    offset = 0
+    count = 0
+    try:
+        while offset != HALT:
+            handler, params, op = decoded[offset]
+            offset = handler(memory, stack, registers, offset, params, decoded)
+            count += 1
+    except Stop:
+        pass
+    return count
+
+
+def run_one(name, engine, scale, spawned, challenge=None, script=None):
+    """
+    Runs one workload on one engine in this process, which should be a fresh one started at time spawned.
+    Returns the result dict.
+    """
+    memory, stdin = prepare(name, scale, challenge, script)
+    pristine = memory[:]
+    sink = open(os.devnull, 'w')
+    if engine == 'jit':
+        from blocks import BlockCache, run_tiered
+        decoded = BlockCache(memory, stdin, sink)
+        step = run_tiered
+    else:
+        decoded = DecodeCache(memory, stdin, sink)
+        step = run_batch
+    stack = []
+    registers = [0] * 8
+    offset = 0
+    halt = False
+    startup = time.time() - spawned
+    began = time.perf_counter()
+    try:
+        if engine == 'inner':
+            while not halt:
+                halt, memory, stack, registers, offset = run_inner(memory, stack, registers, offset, None, -1, decoded)
+        else:
+            while not halt:
+                offset, halt = step(memory, stack, registers, offset, decoded, batch_size)
+    except Stop:
+        pass
+    seconds = time.perf_counter() - began
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Counted separately for every engine, since fused runs of instructions go by as one.
+    count = count_instructions(pristine, prepare(name, scale, challenge, script)[1], sink)
+    return {'workload': name, 'engine': engine, 'instructions': count, 'seconds': seconds,
+            'ips': count / seconds if seconds else 0.0, 'startup': startup, 'peak_rss_kb': peak}
+
+
+def measure(name, engine, scale, challenge=None, script=None):
+    """
+    Runs one workload on one engine in a fresh interpreter.
+    Returns the result dict.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, engine, '--scale', str(scale),
+               '--challenge', challenge or '', '--spawned', repr(time.time())]
+    if script:
+        command += ['--script', script]
+    done = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(done.stdout.splitlines()[-1])
+
+
+def micro(repeat=200000):
+    """
+    Times each of micro_cases called directly, with its generic handler and with its specialised one, and the
+    arithmetic workload through run_batch both ways.
+    Returns (what, generic ns, specialised ns) rows, per instruction.
+    """
+    rows = []
+    sink = open(os.devnull, 'w')
+    for case in micro_cases:
+        op = opcodes[case[0]]
+        params = tuple(assemble([case])[1:])
+        timings = []
+        for handler in (handlers[op], handler_for(op, params, 100)):
+            memory = load_memory([])
+            registers = [1, 2, 3, 4, 5, 6, 7, 8]
+            stack = []
+            decoded = DecodeCache(memory, None, sink)
+            began = time.perf_counter()
+            for _ in range(repeat):
+                handler(memory, stack, registers, 100, params, decoded)
+            timings.append((time.perf_counter() - began) * 1e9 / repeat)
+        rows.append((' '.join(str(x) for x in case),) + tuple(timings))
+    words = arithmetic(1)
+    count = count_instructions(load_memory(words), None, sink)
+    timings = []
+    for specialize in (False, True):
+        memory = load_memory(words)
+        decoded = DecodeCache(memory, None, sink)
+        decoded.specialize = specialize
+        stack = []
+        registers = [0] * 8
+        offset = 0
+        halt = False
+        began = time.perf_counter()
+        while not halt:
+            offset, halt = run_batch(memory, stack, registers, offset, decoded, batch_size)
+        timings.append((time.perf_counter() - began) * 1e9 / count)
+    rows.append(('arithmetic (run_batch)',) + tuple(timings))
+    return rows
+
+
+def compare(old, new, outfile=sys.stdout):
+    """
+    Prints how each (workload, engine) pair in new does against the same pair in old.
+    """
+    before = {(result['workload'], result['engine']): result for result in old['results']}
+    for result in new['results']:
+        previous = before.get((result['workload'], result['engine']))
+        if previous is None or not previous['ips']:
+            continue
+        ratio = result['ips'] / previous['ips']
+        verdict = 'slower' if ratio < 0.9 else 'faster' if ratio > 1.1 else 'same'
+        print("{:<16} {:<6} {:>12.0f} -> {:>12.0f} ips  x{:.2f}  {}".format(
+            result['workload'], result['engine'], previous['ips'], result['ips'], ratio, verdict), file=outfile)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="VM throughput benchmarks.")
+    parser.add_argument('-w', '--workload', dest="workloads", help="Workload to run, all of them if not given", choices=list(workloads) + ['replay'], action='append', default=[])
+    parser.add_argument('-e', '--engine', dest="engines", help="Engine to run on, all of them if not given", choices=engines, action='append', default=[])
+    parser.add_argument('-n', '--scale', dest="scale", help="Size of the synthetic workloads, in about 100k instructions each", type=int, default=10)
+    parser.add_argument('-c', '--challenge', dest="challenge", help="Challenge binary for the replay workload, skipped if it's not there", metavar="INFILE", default='challenge.bin')
+    parser.add_argument('-s', '--script', dest="script", help="Walkthrough script for the replay workload", metavar="SCRIPT", required=False)
+    parser.add_argument('-o', '--output', dest="output_file", help="Results file to write", metavar="FILE", default='bench.json')
+    parser.add_argument('--compare', dest="compare_file", help="Earlier results file to compare against", metavar="FILE", required=False)
+    parser.add_argument('--micro', dest="micro", help="Time single instructions on the generic and the specialised handlers instead", action='store_true')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--spawned', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    if options.child:
+        name, engine = options.child
+        print(json.dumps(run_one(name, engine, options.scale, options.spawned, options.challenge, options.script)))
+        sys.exit(0)
+    if options.micro:
+        print("{:<24} {:>10} {:>12}".format("instruction", "generic", "specialised"))
+        for what, generic, special in micro():
+            print("{:<24} {:>7.1f} ns {:>9.1f} ns  x{:.2f}".format(what, generic, special, generic / special))
+        sys.exit(0)
+    names = options.workloads or list(workloads) + ['replay']
+    if 'replay' in names and not os.path.exists(options.challenge):
+        print("No", options.challenge, "found, skipping the replay workload.", file=sys.stderr)
+        names.remove('replay')
+    output = {}
+    output['python'] = platform.python_version()
+    output['machine'] = platform.machine()
+    output['scale'] = options.scale
+    output['results'] = []
+    for name in names:
+        for engine in options.engines or engines:
+            result = measure(name, engine, options.scale, options.challenge, options.script)
+            output['results'].append(result)
+            print("{:<16} {:<6} {:>10} instructions {:>8.3f}s {:>12.0f} ips  startup {:.3f}s  peak {} KB".format(
+                name, engine, result['instructions'], result['seconds'], result['ips'], result['startup'],
+                result['peak_rss_kb']))
+    with open(options.output_file, 'w') as f:
+        json.dump(output, f, indent=1)
+    if options.compare_file:
+        with open(options.compare_file) as f:
+            compare(json.load(f), output)
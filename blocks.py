@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""
+Tiered execution: instructions are interpreted from the decode cache, and once a basic block has been entered
+often enough it gets turned into straight-line Python source and compiled into a function.
+Blocks end at control flow (jmp, jt, jf, call, ret) and right after anything that writes to memory, since that
+could be rewriting code. halt, in, data and debugger traps are never compiled, so a compiled block can't stop part way through.
+"""
+
+import sys
+from vm import DecodeCache, FUSED, HALT, Interrupted, Stop, op_trap
+
+# Ops that move execution somewhere other than the next instruction, so where they land is a block head.
+transfers = {6, 7, 8, 17, 18}
+# Executions of a block head before it gets compiled.
+threshold = 50
+max_block_len = 64
+# Local aliases a block sets up, only if it uses them.
+preamble = [('write', 'write = (decoded.stdout or sys.stdout).write'), ('push', 'push = stack.append'),
+            ('pop', 'pop = stack.pop'), ('invalidate', 'invalidate = decoded.invalidate')]
+folds = {9: lambda b, c: (b + c) % 32768, 10: lambda b, c: (b * c) % 32768, 11: lambda b, c: b % c,
+         12: lambda b, c: b & c, 13: lambda b, c: b | c}
+
+
+class BlockCache(DecodeCache):
+    """
+    Decode cache that also holds compiled blocks, keyed by their first address as (function, instruction count).
+    A write landing on any word of a compiled block throws the block away, along with its execution count.
+    """
+    def __init__(self, memory, stdin=None, stdout=None):
+        super().__init__(memory, stdin, stdout)
+        self.blocks = {}
+        self.heat = {}
+        self.owners = {}
+
+    def invalidate(self, location):
+        if self.covered[location]:
+            super().invalidate(location)
+            for start in self.owners.pop(location, ()):
+                self.blocks.pop(start, None)
+                self.heat.pop(start, None)
+
+    def reset(self):
+        super().reset()
+        self.blocks.clear()
+        self.heat.clear()
+        self.owners.clear()
+
+    def warm(self, offset):
+        """
+        Counts an arrival at a block head, and compiles the block once it's hot.
+        """
+        heat = self.heat.get(offset, 0) + 1
+        self.heat[offset] = heat
+        if heat >= threshold:
+            block = compile_block(self, offset)
+            if block is None:
+                # Nothing here can be compiled, so stop counting it.
+                self.heat[offset] = -sys.maxsize
+            else:
+                self.blocks[offset] = block
+
+
+def operand(value):
+    """
+    Source for reading an operand, a literal or a register local.
+    """
+    if value < 32768:
+        return str(value)
+    return 'r{}'.format(value - 32768)
+
+
+def write_register(registers, location, value, next_offset):
+    """
+    What a compiled wmem does with an address past memory, returning where the block carries on.
+    """
+    registers[location % 32768] = value
+    return next_offset
+
+
+def block_source(decoded, start):
+    """
+    Generates the source of a function running the block at start.
+    Returns the source, the number of instructions in it and the addresses it covers, or None if there's no block.
+    """
+    body = []
+    used = set()
+    written = set()
+    offset = start
+    count = 0
+    ended = False
+    terminated = False
+    while count < max_block_len and not ended and not terminated:
+        handler, params, op = decoded[offset]
+        if op == FUSED:
+            text, sets, offset = params
+            if text:
+                body.append('write({!r})'.format(text))
+            for register, value in sets:
+                written.add(register)
+                body.append('r{} = {}'.format(register, value))
+            count += 1
+            continue
+        if op in (0, 20) or op > 21 or handler is op_trap or offset in decoded.intrinsics or any(x > 32775 for x in params):
+            break
+        for x in params:
+            if x > 32767:
+                used.add(x - 32768)
+        next_offset = offset + 1 + len(params)
+        values = [operand(x) for x in params]
+        immediate = all(x < 32768 for x in params[1:])
+        expr = None
+        if op == 1:
+            expr = values[1]
+        elif op == 3:
+            expr = 'pop()'
+        elif op in (4, 5):
+            if immediate:
+                expr = str(int(params[1] == params[2] if op == 4 else params[1] > params[2]))
+            else:
+                expr = '1 if {} {} {} else 0'.format(values[1], '==' if op == 4 else '>', values[2])
+        elif op in (9, 10, 11, 12, 13):
+            # Both operands known up front folds to a constant, except mod by zero which has to fail when it runs.
+            if immediate and not (op == 11 and params[2] == 0):
+                expr = str(folds[op](params[1], params[2]))
+            else:
+                expr = ['({} + {}) & 32767', '({} * {}) & 32767', '{} % {}', '{} & {}', '{} | {}'][op - 9].format(values[1], values[2])
+        elif op == 14:
+            expr = str(32767 - params[1]) if immediate else '32767 - {}'.format(values[1])
+        elif op == 15:
+            expr = 'memory[{}]'.format(values[1])
+        elif op == 2:
+            body.append('push({})'.format(values[0]))
+        elif op == 16:
+            if params[0] > 32767:
+                # Like set_value, an address past memory names a register, written after the locals go back.
+                body.append('where = {0}\nif where > 32767:\n    return write_register(registers, where, {1}, {2})\n'
+                            'memory[where] = {1}\ninvalidate(where)'.format(values[0], values[1], next_offset))
+            else:
+                body.append('memory[{0}] = {1}\ninvalidate({0})'.format(values[0], values[1]))
+            ended = True
+        elif op == 19:
+            if params[0] < 32768:
+                body.append('write({!r})'.format(chr(params[0])))
+            else:
+                body.append('write(chr({}))'.format(values[0]))
+        elif op == 6:
+            body.append('return {}'.format(params[0]))
+            terminated = True
+        elif op in (7, 8):
+            body.append('if {} {} 0:\n    return {}'.format(values[0], '!=' if op == 7 else '==', values[1]))
+            body.append('return {}'.format(next_offset))
+            terminated = True
+        elif op == 17:
+            body.append('push({})\nreturn {}'.format(next_offset, values[0]))
+            terminated = True
+        elif op == 18:
+            body.append('return pop()')
+            terminated = True
+        if expr is not None:
+            if params[0] > 32767:
+                written.add(params[0] - 32768)
+                body.append('{} = {}'.format(values[0], expr))
+            else:
+                body.append('memory[{0}] = {1}\ninvalidate({0})'.format(params[0], expr))
+                ended = True
+        count += 1
+        offset = next_offset
+    if count == 0:
+        return None
+    if not terminated:
+        body.append('return {}'.format(offset))
+    # Every return hands the register locals back first.
+    writeback = ''.join('registers[{0}] = r{0}\n'.format(idx) for idx in sorted(written))
+    text = '\n'.join(body)
+    lines = ['def block(memory, stack, registers, decoded):']
+    lines += ['    ' + setup for name, setup in preamble if name + '(' in text]
+    lines += ['    r{0} = registers[{0}]'.format(idx) for idx in sorted(used)]
+    for statement in body:
+        for line in statement.split('\n'):
+            indent = line[:len(line) - len(line.lstrip())]
+            if line.lstrip().startswith('return') and writeback:
+                lines += ['    ' + indent + wb for wb in writeback.splitlines()]
+            lines.append('    ' + line)
+    return '\n'.join(lines) + '\n', count, range(start, offset)
+
+
+def compile_block(decoded, start):
+    """
+    Compiles the block at start and registers the words it covers, so writes to them invalidate it.
+    Returns (function, instruction count), or None if there's nothing compilable there.
+    """
+    generated = block_source(decoded, start)
+    if generated is None:
+        return None
+    source, count, words = generated
+    namespace = {'sys': sys, 'write_register': write_register}
+    exec(compile(source, '<block {}>'.format(start), 'exec'), namespace)
+    for word in words:
+        decoded.owners.setdefault(word, []).append(start)
+    return namespace['block'], count
+
+
+def run_tiered(memory, stack, registers, offset, decoded, count):
+    """
+    Drop in for vm.run_batch, running compiled blocks where there are any and interpreting everything else.
+    decoded has to be a BlockCache.
+    Returns the offset to carry on from and whether the VM halted.
+    """
+    blocks = decoded.blocks
+    executed = 0
+    try:
+        while executed < count:
+            block = blocks.get(offset)
+            if block is not None:
+                offset = block[0](memory, stack, registers, decoded)
+                executed += block[1]
+                if offset not in blocks:
+                    decoded.warm(offset)
+                continue
+            handler, params, op = decoded[offset]
+            next_offset = handler(memory, stack, registers, offset, params, decoded)
+            if next_offset == HALT:
+                return offset, True
+            offset = next_offset
+            executed += 1
+            if op in transfers and offset not in blocks:
+                decoded.warm(offset)
+    except Interrupted:
+        pass
+    except Stop as stop:
+        stop.offset = offset
+        raise
+    return offset, False
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Binary checkpoint format, all little-endian:
+    header: magic, version, flags, offset, stack length, 8 registers
+    body: stack words, then either the full 32768 word memory image or, for a delta, the base's digest,
+          the base file name, and the pages that differ from the base followed by their contents.
+If the compressed flag is set, the whole body is zlib compressed.
+Old JSON checkpoints don't start with the magic, so they're still recognised and loaded.
+"""
+
+from array import array
+import hashlib
+import json
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'SYNX'
+VERSION = 1
+COMPRESSED = 1
+DELTA = 2
+PAGE_WORDS = 256
+PAGE_BYTES = 2 * PAGE_WORDS
+NUM_PAGES = 32768 // PAGE_WORDS
+HEADER = struct.Struct('<4sHHHI8H')
+
+
+def to_bytes(words):
+    """
+    Returns the words as raw little-endian bytes.
+    """
+    words = array('H', words)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tobytes()
+
+
+def from_bytes(raw):
+    """
+    Returns an array of words from raw little-endian bytes.
+    """
+    words = array('H')
+    words.frombytes(raw)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def digest(memory):
+    """
+    Fingerprint of a memory image, used to tie deltas to the snapshot they were taken against.
+    """
+    return hashlib.sha1(to_bytes(memory)).digest()
+
+
+def state_digest(memory, stack, registers, offset):
+    """
+    Fingerprint of a whole VM state, as a hex string, so runs that ended up in the same place can be spotted.
+    """
+    state = hashlib.sha1(to_bytes(memory))
+    state.update(struct.pack('<9H', offset % 65536, *registers))
+    state.update(to_bytes(stack))
+    return state.hexdigest()
+
+
+def changed_pages(memory, base):
+    """
+    Returns the indices of the pages where memory differs from base.
+    """
+    current = to_bytes(memory)
+    previous = to_bytes(base)
+    return [page for page in range(NUM_PAGES)
+            if current[page * PAGE_BYTES : (page + 1) * PAGE_BYTES] != previous[page * PAGE_BYTES : (page + 1) * PAGE_BYTES]]
+
+
+def encode(memory, stack, registers, offset, base=None, base_name='', compress=False):
+    """
+    Packs a machine state into the binary checkpoint format.
+    If base memory is given only the pages changed since then are stored, and base_name records where to find it.
+    """
+    flags = 0
+    body = to_bytes(stack)
+    if base is None:
+        body += to_bytes(memory)
+    else:
+        flags |= DELTA
+        pages = changed_pages(memory, base)
+        current = to_bytes(memory)
+        name = base_name.encode('utf-8')
+        body += digest(base) + struct.pack('<H', len(name)) + name
+        body += struct.pack('<H', len(pages)) + to_bytes(pages)
+        body += b''.join(current[page * PAGE_BYTES : (page + 1) * PAGE_BYTES] for page in pages)
+    if compress:
+        flags |= COMPRESSED
+        body = zlib.compress(body, 1)
+    return HEADER.pack(MAGIC, VERSION, flags, offset, len(stack), *registers) + body
+
+
+def decode(data, base=None, base_dir='.'):
+    """
+    Unpacks a binary checkpoint into a state dict, same as load_state returns.
+    A delta needs its base memory, which gets loaded from the recorded file name if it isn't passed in.
+    """
+    magic, version, flags, offset, stack_len, *registers = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version {} checkpoint".format(VERSION))
+    body = data[HEADER.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    stack = from_bytes(body[:2 * stack_len]).tolist()
+    pos = 2 * stack_len
+    if flags & DELTA:
+        base_digest = body[pos : pos + 20]
+        name_len, = struct.unpack_from('<H', body, pos + 20)
+        name = body[pos + 22 : pos + 22 + name_len].decode('utf-8')
+        pos += 22 + name_len
+        if base is None:
+            base = load(os.path.join(base_dir, name))['memory']
+        if digest(base) != base_digest:
+            raise ValueError("Delta checkpoint doesn't match its base snapshot: " + name)
+        num_pages, = struct.unpack_from('<H', body, pos)
+        pages = from_bytes(body[pos + 2 : pos + 2 + 2 * num_pages])
+        pos += 2 + 2 * num_pages
+        memory = array('H', base)
+        for page in pages:
+            memory[page * PAGE_WORDS : (page + 1) * PAGE_WORDS] = from_bytes(body[pos : pos + PAGE_BYTES])
+            pos += PAGE_BYTES
+    else:
+        memory = from_bytes(body[pos : pos + 2 * 32768])
+    return {'memory': memory, 'stack': stack, 'registers': registers, 'offset': offset}
+
+
+def save(path, memory, stack, registers, offset, base=None, base_path=None, compress=False):
+    """
+    Writes a checkpoint file. Passing base memory and the path it was saved to writes a delta against it.
+    """
+    base_name = ''
+    if base_path:
+        base_name = os.path.relpath(base_path, os.path.dirname(os.path.abspath(path)))
+    with open(path, 'wb') as f:
+        f.write(encode(memory, stack, registers, offset, base, base_name, compress))
+
+
+def load(path, base=None):
+    """
+    Reads a checkpoint file, either binary or an old JSON one.
+    Returns the state dict with memory as an array of words.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        state = json.loads(data)
+        state['memory'] = array('H', state['memory'])
+        return state
+    return decode(data, base, os.path.dirname(os.path.abspath(path)))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""
+Control server: drives VMs over a local Unix socket instead of the ctrl+c console.
+Each VM runs as an asyncio task, a slice of instructions at a time, handing the event loop back after every slice,
+so commands get answered between slices without signals or a thread blocked on the terminal. An 'in' with nothing
+queued stops the VM before it changes anything, and it sleeps until input arrives.
+Clients send one command per line and get JSON lines back: a reply to each command, and events pushed as they
+happen, 'output' with whatever the VM printed, 'input' when it's waiting for a line, 'break' when a breakpoint or
+watchpoint is hit (which pauses it), 'error' when the guest faults (which halts it, and only it), and 'halt'. Every
+client gets every event. Events from before anyone connected are held for the first client.
+"""
+
+import os
+import stat
+import json
+import asyncio
+import argparse
+import checkpoint
+import intrinsics
+import memtools
+import debugger
+from vm import Break, DecodeCache, Stop, load_memory, load_program, run_batch
+
+# Instructions run between looking for commands. Small enough for replies to come back within a few milliseconds.
+slice_size = 10000
+debugger_verbs = {'break', 'watch', 'list', 'enable', 'disable', 'delete'}
+usage = ("input TEXT | pause | resume | step [N] | state | checkpoint [FILE] | mem COMMAND | halt | quit\n"
+         "mem: " + memtools.usage + "\n" + debugger.usage)
+
+
+class NeedInput(Stop):
+    """
+    Raised by an 'in' when nothing is queued, before it changes anything.
+    """
+
+
+class QueuedInput:
+    """
+    Feeds 'in' from the text sent with input commands.
+    """
+    def __init__(self):
+        self.text = ''
+        self.pos = 0
+
+    def add(self, text):
+        self.text = self.text[self.pos:] + text
+        self.pos = 0
+
+    def pending(self):
+        return len(self.text) - self.pos
+
+    def read(self, size=1):
+        if self.pos >= len(self.text):
+            raise NeedInput("waiting for input")
+        chunk = self.text[self.pos : self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+
+class QueuedOutput:
+    """
+    Collects what 'out' writes until it's sent on after the slice.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        text = ''.join(self.parts)
+        self.parts = []
+        return text
+
+
+def encode(messages):
+    return b''.join(json.dumps(message).encode() + b'\n' for message in messages)
+
+
+class Session:
+    """
+    One VM and the clients connected to it.
+    """
+    def __init__(self, memory, stack, registers, offset, jit=False, host=None, paused=False):
+        self.memory = memory
+        self.stack = stack
+        self.registers = registers
+        self.offset = offset
+        self.run_fast = run_batch
+        self.decoded = DecodeCache(memory)
+        if jit:
+            from blocks import BlockCache, run_tiered
+            self.run_fast = run_tiered
+            self.decoded = BlockCache(memory)
+        for address, function in (host or {}).items():
+            self.decoded.add_intrinsic(address, function)
+        self.input = QueuedInput()
+        self.output = QueuedOutput()
+        self.decoded.stdin = self.input
+        self.decoded.stdout = self.output
+        self.debugger = debugger.Debugger(self.decoded)
+        self.paused = paused
+        self.waiting = False
+        self.halted = False
+        self.clients = set()
+        self.backlog = []
+        self.wake = asyncio.Event()
+
+    def state(self):
+        return {'offset': self.offset, 'registers': self.registers, 'stack': self.stack, 'paused': self.paused,
+                'waiting': self.waiting, 'halted': self.halted, 'queued': self.input.pending()}
+
+    def set_fusion(self, fuse):
+        """
+        Turns fusing runs of instructions on or off, dropping everything decoded if that changes anything.
+        """
+        if self.decoded.fuse != fuse:
+            self.decoded.fuse = fuse
+            self.decoded.reset()
+
+    def run(self, count, step=None):
+        """
+        Runs up to count instructions, with step if given, or the fast loop.
+        Returns the events to send for what happened.
+        """
+        events = []
+        try:
+            self.offset, self.halted = (step or self.run_fast)(self.memory, self.stack, self.registers, self.offset,
+                                                               self.decoded, count)
+        except NeedInput as stop:
+            self.offset = stop.offset
+            self.waiting = True
+            events.append({'event': 'input', 'offset': self.offset})
+        except Break as hit:
+            self.offset = hit.offset
+            self.paused = True
+            events.append({'event': 'break', 'offset': self.offset, 'text': str(hit)})
+        except Exception as error:
+            # A guest fault, like reading past memory or mod by zero, ends this VM and no other.
+            self.halted = True
+            events.append({'event': 'error', 'text': "{}: {}".format(type(error).__name__, error)})
+        text = self.output.take()
+        if text:
+            events.insert(0, {'event': 'output', 'text': text})
+        if self.halted:
+            events.append({'event': 'halt', 'offset': self.offset})
+        return events
+
+    async def execute(self):
+        """
+        Runs the VM a slice at a time until it halts, sleeping while it's paused or waiting for input.
+        """
+        while not self.halted:
+            if self.paused or self.waiting:
+                await self.wake.wait()
+                self.wake.clear()
+                continue
+            await self.send(self.run(slice_size))
+            await asyncio.sleep(0)
+
+    def command(self, line):
+        """
+        Runs one client command.
+        Returns the reply and any events it caused.
+        """
+        verb, _, rest = line.strip().partition(' ')
+        reply = {'reply': verb}
+        events = []
+        try:
+            if verb == 'input':
+                self.input.add(rest + '\n')
+                self.waiting = False
+                reply['queued'] = self.input.pending()
+            elif verb in ('pause', 'resume'):
+                self.paused = verb == 'pause'
+                if not self.paused:
+                    self.set_fusion(True)
+                reply.update(self.state())
+            elif verb == 'step':
+                # Stepping leaves it paused, however it was before. It's interpreted with fusion off, which stays off
+                # until the next resume, so N is exactly how many instructions run.
+                self.paused = True
+                self.waiting = False
+                if not self.halted:
+                    self.set_fusion(False)
+                    events = self.run(int(rest or 1), run_batch)
+                reply.update(self.state())
+            elif verb == 'state':
+                reply.update(self.state())
+            elif verb == 'checkpoint':
+                path = rest or 'checkpoint.chk'
+                checkpoint.save(path, self.memory, self.stack, self.registers, self.offset)
+                reply['file'] = path
+            elif verb == 'mem':
+                reply['text'] = memtools.command(rest, self.memory)
+            elif verb in debugger_verbs:
+                reply['text'] = self.debugger.command(line)
+            elif verb == 'halt':
+                self.halted = True
+                events.append({'event': 'halt', 'offset': self.offset})
+            else:
+                reply['error'] = usage
+        except (ValueError, OSError) as error:
+            reply['error'] = "{}: {}".format(type(error).__name__, error)
+        self.wake.set()
+        return reply, events
+
+    async def send(self, events, writers=None):
+        """
+        Sends events to writers, or every client. With no clients they're kept for the first to connect.
+        """
+        if not events:
+            return
+        if writers is None:
+            if not self.clients:
+                self.backlog += events
+                return
+            writers = self.clients
+        data = encode(events)
+        for writer in list(writers):
+            try:
+                writer.write(data)
+                await writer.drain()
+            except ConnectionError:
+                self.clients.discard(writer)
+
+    async def serve_client(self, reader, writer):
+        """
+        Answers one client's commands until it quits or goes away.
+        """
+        self.clients.add(writer)
+        backlog, self.backlog = self.backlog, []
+        await self.send(backlog, [writer])
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or line.strip() == b'quit':
+                    break
+                reply, events = self.command(line.decode())
+                # Written before anything else gets to run, so the reply goes out even if this halted the VM.
+                writer.write(encode(events + [reply]))
+                await self.send(events, self.clients - {writer})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+
+async def serve(session, path):
+    """
+    Runs session, taking commands on a Unix socket at path, until the VM halts.
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    server = await asyncio.start_unix_server(session.serve_client, path)
+    try:
+        await session.execute()
+    finally:
+        server.close()
+        for writer in list(session.clients):
+            writer.close()
+        await server.wait_closed()
+        os.remove(path)
+
+
+async def serve_all(sessions, paths):
+    await asyncio.gather(*(serve(session, path) for session, path in zip(sessions, paths)))
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Runs VMs driven by commands over Unix sockets.")
+    parser.add_argument('-f', '--file', dest="input_file", help="Input (challenge).bin", metavar="INFILE", required=False)
+    parser.add_argument('-x', '--checkpoint', dest="checkpoint", help="Checkpoint to start from instead of the start of the binary", metavar="CHECKPOINT", required=False)
+    parser.add_argument('-u', '--socket', dest="socket", help="Socket to listen on, with .N added for each VM when there's more than one", metavar="PATH", default='synacor.sock')
+    parser.add_argument('-n', '--vms', dest="vms", help="Number of VMs to run from the same starting state", type=int, default=1)
+    parser.add_argument('-p', '--paused', dest="paused", help="Start paused, until a client sends resume or step", action='store_true')
+    parser.add_argument('-i', '--intrinsics', dest="intrinsics", help="Run host intrinsics from a .json config or module ('intrinsics' for the built in ones)", metavar="SPEC", action='append', default=[])
+    parser.add_argument('-j', '--jit', dest="jit", help="Compile hot blocks to Python functions", action='store_true')
+    args = parser.parse_args()
+    if not args.input_file and not args.checkpoint:
+        parser.error("one of -f/--file or -x/--checkpoint is required")
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    if options.checkpoint:
+        state = checkpoint.load(options.checkpoint)
+        memory, stack, registers, offset = load_memory(state['memory']), state['stack'], state['registers'], state['offset']
+    else:
+        memory, stack, registers, offset = load_program(options.input_file), [], [0] * 8, 0
+    host = {}
+    for spec in options.intrinsics:
+        host.update(intrinsics.load(spec))
+    paths = [options.socket] if options.vms == 1 else ['{}.{}'.format(options.socket, n) for n in range(options.vms)]
+
+    async def start():
+        sessions = [Session(memory[:], stack[:], registers[:], offset, options.jit, host, options.paused)
+                    for _ in paths]
+        print("listening on", ', '.join(paths))
+        await serve_all(sessions, paths)
+
+    try:
+        asyncio.run(start())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Breakpoints and watchpoints.
+Nothing is checked per instruction. Instead the debugger attaches to the decode cache and tells it which instructions
+to decode as traps: ones at a breakpoint's address, and ones that can touch memory a watchpoint covers. Only those
+call back into the debugger when they run, and with nothing set it detaches, so the fast path is exactly what it was.
+rmem and wmem through a register can touch any address, so any watchpoint traps all of those.
+Conditions are Python expressions over r0-r7, mem (memory), stack and offset, e.g. 'r0 == 3 and mem[2732] > 10'.
+"""
+
+from vm import Break
+
+# Ops whose first operand is where they write their result, straight into memory if it's an address.
+writes_first = {1, 3, 4, 5, 9, 10, 11, 12, 13, 14, 15, 20}
+usage = ("break ADDR [if EXPR] | watch [r|w|rw] START[-END] [if EXPR] | list | enable N | disable N | delete N")
+
+
+class Point:
+    """
+    A breakpoint (kind 'break', start == end) or a watchpoint (kind 'r', 'w' or 'rw') on the addresses start to end.
+    """
+    def __init__(self, number, kind, start, end, condition=None):
+        self.number = number
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.condition = condition
+        self.code = compile(condition, '<condition>', 'eval') if condition else None
+        self.enabled = True
+        self.hits = 0
+
+    def __str__(self):
+        where = str(self.start) if self.start == self.end else '{}-{}'.format(self.start, self.end)
+        text = "{}: {} {}".format(self.number, 'break' if self.kind == 'break' else 'watch ' + self.kind, where)
+        if self.condition:
+            text += " if " + self.condition
+        return text + " ({}, hits: {})".format('enabled' if self.enabled else 'disabled', self.hits)
+
+    def covers(self, address):
+        return self.start <= address <= self.end
+
+
+def accesses(op, params, registers=None):
+    """
+    Returns the memory an instruction reads and writes, as (reads, writes) lists of addresses. Addresses held in a
+    register are looked up if registers are given, and None otherwise, since they aren't known until it runs.
+    """
+    def address(param):
+        if param < 32768:
+            return param
+        return None if registers is None else registers[param - 32768]
+    reads = []
+    writes = []
+    if op == 15:
+        reads.append(address(params[1]))
+    if op in writes_first and params[0] < 32768:
+        writes.append(params[0])
+    elif op == 16:
+        writes.append(address(params[0]))
+    return reads, writes
+
+
+class Debugger:
+    """
+    Breakpoints and watchpoints by number, for one decode cache.
+    """
+    def __init__(self, decoded):
+        self.decoded = decoded
+        self.points = {}
+        self.next_number = 1
+        # Set after a hit, so carrying on runs the instruction instead of hitting it again.
+        self.resume = None
+
+    def update(self):
+        """
+        Attaches to the decode cache if anything is enabled, detaches if not, and has everything decoded again.
+        """
+        enabled = any(point.enabled for point in self.points.values())
+        self.decoded.debugger = self if enabled else None
+        self.decoded.reset()
+
+    def add(self, kind, start, end=None, condition=None):
+        """
+        Adds a breakpoint or watchpoint. Returns it.
+        """
+        point = Point(self.next_number, kind, start, start if end is None else end, condition)
+        self.points[point.number] = point
+        self.next_number += 1
+        self.update()
+        return point
+
+    def traps(self, offset, op, params):
+        """
+        Whether the instruction at offset needs to be decoded as a trap.
+        """
+        reads, writes = accesses(op, params)
+        for point in self.points.values():
+            if not point.enabled:
+                continue
+            if point.kind == 'break':
+                if point.start == offset:
+                    return True
+                continue
+            watched = (reads if 'r' in point.kind else []) + (writes if 'w' in point.kind else [])
+            if any(address is None or point.covers(address) for address in watched):
+                return True
+        return False
+
+    def check(self, memory, stack, registers, offset, op, params):
+        """
+        Called by a trap before its instruction runs. Raises Break if a point is hit.
+        """
+        resume, self.resume = self.resume, None
+        if resume == offset:
+            return
+        reads, writes = accesses(op, params, registers)
+        for point in self.points.values():
+            if not point.enabled:
+                continue
+            if point.kind == 'break':
+                hit = point.start == offset
+            else:
+                watched = (reads if 'r' in point.kind else []) + (writes if 'w' in point.kind else [])
+                hit = any(point.covers(address) for address in watched)
+            if hit and self.condition_holds(point, memory, stack, registers, offset):
+                point.hits += 1
+                self.resume = offset
+                raise Break("hit {} at offset: {}".format(point, offset))
+
+    def condition_holds(self, point, memory, stack, registers, offset):
+        if point.code is None:
+            return True
+        names = {'r{}'.format(idx): value for idx, value in enumerate(registers)}
+        names.update(mem=memory, stack=stack, offset=offset)
+        try:
+            return bool(eval(point.code, {}, names))
+        except Exception as error:
+            print("condition of", point.number, "failed:", error)
+            return True
+
+    def command(self, line):
+        """
+        Runs one console command. Returns what to print.
+        """
+        words = line.split()
+        if not words:
+            return usage
+        condition = None
+        if 'if' in words:
+            at = words.index('if')
+            condition = ' '.join(words[at + 1:])
+            words = words[:at]
+        verb = words[0]
+        try:
+            if verb == 'list':
+                return '\n'.join(str(point) for point in self.points.values()) or "no breakpoints."
+            if verb in ('enable', 'disable', 'delete'):
+                point = self.points[int(words[1])]
+                if verb == 'delete':
+                    del self.points[point.number]
+                else:
+                    point.enabled = verb == 'enable'
+                self.update()
+                return "{}d {}".format(verb, point.number)
+            if verb == 'watch':
+                kind = words[1] if words[1] in ('r', 'w', 'rw') else 'w'
+                start, _, end = words[-1].partition('-')
+                return "set " + str(self.add(kind, int(start), int(end or start), condition))
+            if verb == 'break':
+                words = words[1:]
+            return "set " + str(self.add('break', int(words[0]), None, condition))
+        except (IndexError, KeyError, ValueError, SyntaxError) as error:
+            return "{}: {}\n{}".format(type(error).__name__, error, usage)
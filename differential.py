@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Differential testing of the execution engines.
+Random programs get run on the plain generic handlers, one instruction at a time with nothing specialised or fused,
+and then on each engine under test. A program that halts within the budget has to leave every engine with the same
+memory, stack, registers, offset and output, and one that fails has to fail the same way everywhere. Programs that
+don't finish within the budget are skipped.
+The programs are weighted towards what the engines treat specially: operands naming registers, reads of words that
+hold register numbers, and writes through registers, into the program's own code, and into registers by way of an
+address past memory.
+"""
+
+import io
+import sys
+import random
+import argparse
+from vm import DecodeCache, HALT, load_memory, param_lens, run_batch
+import blocks
+from blocks import BlockCache, run_tiered
+from journal import Journal
+
+# Engines checked against the generic handlers.
+engines = ['batch', 'jit', 'journal']
+# Ops to generate, with halt, in and data left rarer than the rest.
+weights = {0: 1, 1: 8, 2: 4, 3: 4, 4: 3, 5: 3, 6: 2, 7: 3, 8: 3, 9: 6, 10: 3, 11: 2, 12: 2, 13: 2, 14: 2, 15: 5,
+           16: 6, 17: 2, 18: 2, 19: 5, 20: 1, 21: 3}
+ops = list(weights)
+op_weights = list(weights.values())
+
+
+def random_program(rng, length):
+    """
+    Returns the words of a random program of about length words, followed by some data.
+    """
+    instructions = []
+    size = 0
+    while size < length:
+        op = rng.choices(ops, op_weights)[0]
+        instructions.append(op)
+        size += 1 + param_lens[op]
+    data_start = size
+    data = [rng.choice([rng.randrange(32768), rng.randrange(32768, 32776), rng.randrange(20)]) for _ in range(32)]
+    starts = []
+    address = 0
+    for op in instructions:
+        starts.append(address)
+        address += 1 + param_lens[op]
+
+    def operand():
+        pick = rng.random()
+        if pick < 0.45:
+            return rng.randrange(32768, 32776)
+        if pick < 0.7:
+            return rng.randrange(20)
+        if pick < 0.85:
+            return rng.randrange(data_start, data_start + len(data))
+        if pick < 0.97:
+            return rng.randrange(data_start)
+        return rng.randrange(32768)
+    words = []
+    for idx, op in enumerate(instructions):
+        words.append(op)
+        params = [operand() for _ in range(param_lens[op])]
+        if op in (6, 17) or (op in (7, 8) and rng.random() < 0.8):
+            # Mostly forward, to instructions, so a fair share of programs halt.
+            target = rng.choice(starts[idx:] + [size])
+            params[-1] = target if rng.random() < 0.8 else rng.choice(starts)
+        elif op == 19 and rng.random() < 0.7:
+            params[0] = rng.randrange(32, 127)
+        words += params
+    return words + [0] + data
+
+
+def run_reference(memory, stdin, budget):
+    """
+    Runs a program on the generic handlers, stepping one instruction at a time.
+    Returns (outcome, state, instructions run), where outcome is 'halt', 'budget' or the name of the exception it
+    raised.
+    """
+    stdout = io.StringIO()
+    decoded = DecodeCache(memory, stdin, stdout)
+    decoded.specialize = False
+    decoded.fuse = False
+    stack = []
+    registers = [0] * 8
+    offset = 0
+    outcome = 'budget'
+    executed = 0
+    try:
+        while executed < budget:
+            # Counted before it's decoded or run, so one that raises gets as far on the engines.
+            executed += 1
+            handler, params, op = decoded[offset]
+            next_offset = handler(memory, stack, registers, offset, params, decoded)
+            if next_offset == HALT:
+                outcome = 'halt'
+                break
+            offset = next_offset
+    except Exception as error:
+        outcome = type(error).__name__
+    return outcome, (memory, stack, registers, offset, stdout.getvalue()), executed
+
+
+def run_engine(engine, memory, stdin, budget):
+    """
+    Runs a program on one engine, for the number of instructions the reference took.
+    Returns (outcome, state). For the journal, the state is what's left after going all the way back again, which
+    should be the state it started from.
+    """
+    stdout = io.StringIO()
+    journal = None
+    if engine == 'jit':
+        decoded = BlockCache(memory, stdin, stdout)
+        step = run_tiered
+    else:
+        decoded = DecodeCache(memory, stdin, stdout)
+        step = run_batch
+    if engine == 'journal':
+        decoded.fuse = False
+        # Small segments, so going back crosses keyframes as well as undoing instructions.
+        journal = Journal(interval=64, keep=sys.maxsize)
+        step = journal.run_batch
+    stack = []
+    registers = [0] * 8
+    offset = 0
+    try:
+        # Every engine counts a fused run or a block as at most as many instructions as it really is.
+        offset, halt = step(memory, stack, registers, offset, decoded, budget)
+    except Exception as error:
+        return type(error).__name__, None
+    if journal is not None:
+        offset = journal.back(journal.available(), memory, stack, registers, decoded)
+    return 'halt' if halt else 'budget', (memory, stack, registers, offset, stdout.getvalue())
+
+
+def check(words, engines, budget, text):
+    """
+    Runs one program on the reference and on engines.
+    Returns the reference's outcome, and a list of (engine, what differs) for each engine that disagreed.
+    """
+    outcome, expected, executed = run_reference(load_memory(words), io.StringIO(text), budget)
+    if outcome == 'budget':
+        return outcome, []
+    mismatches = []
+    for engine in engines:
+        found, state = run_engine(engine, load_memory(words), io.StringIO(text), executed)
+        if engine == 'journal' and state is not None:
+            wanted = (load_memory(words), [], [0] * 8, 0, expected[4])
+        else:
+            wanted = expected
+        if found != outcome:
+            mismatches.append((engine, "{} instead of {}".format(found, outcome)))
+        elif state is not None:
+            names = ('memory', 'stack', 'registers', 'offset', 'output')
+            differs = [name for name, got, want in zip(names, state, wanted) if got != want]
+            if differs:
+                mismatches.append((engine, "different " + ', '.join(differs)))
+    return outcome, mismatches
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Checks the execution engines against the generic handlers on random programs.")
+    parser.add_argument('-s', '--seed', dest="seed", help="Random seed", type=int, default=0)
+    parser.add_argument('-n', '--programs', dest="programs", help="Number of programs to run", type=int, default=2000)
+    parser.add_argument('-l', '--length', dest="length", help="Length of each program, in words", type=int, default=120)
+    parser.add_argument('-b', '--budget', dest="budget", help="Instructions a program gets to finish in", type=int, default=20000)
+    parser.add_argument('-e', '--engine', dest="engines", help="Engine to check, all of them if not given", choices=engines, action='append', default=[])
+    parser.add_argument('-t', '--threshold', dest="threshold", help="Executions before the jit compiles a block", type=int, default=1)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    blocks.threshold = options.threshold
+    rng = random.Random(options.seed)
+    outcomes = {}
+    failed = 0
+    for number in range(options.programs):
+        words = random_program(rng, options.length)
+        text = ''.join(rng.choice('abc \n') for _ in range(20))
+        outcome, mismatches = check(words, options.engines or engines, options.budget, text)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        for engine, what in mismatches:
+            failed += 1
+            print("program {} (seed {}): {}: {}".format(number, options.seed, engine, what))
+    print("{} programs: {}, {} mismatches".format(
+        options.programs, ', '.join("{} {}".format(count, outcome) for outcome, count in sorted(outcomes.items())),
+        failed))
+    sys.exit(1 if failed else 0)
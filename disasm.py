@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+Recursive descent disassembly.
+Rather than sweeping the file in a line, decoding follows control flow from the entry points through jmp, jt, jf
+and call targets, so only what's reachable is treated as code and everything else is data. Call targets are taken
+as function starts. Jumps and calls through registers can't be followed, so extra entry points can be given.
+The result is a program dict:
+    'instructions': {address: (op, params)}
+    'functions': sorted function start addresses
+    'entries': the entry points it was built from
+    'size': number of words in the binary
+Analyses get cached on disk, keyed by the hash of the binary and the entry points.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from vm import op_table, param_lens, read_file, split_file
+
+cache_dir = '.disasm_cache'
+# Ops after which execution doesn't carry on to the next instruction.
+stops = {0, 6, 18}
+
+
+def successors(address, op, params):
+    """
+    Returns (jump targets, call targets, falls through) for an instruction. Register targets aren't known statically.
+    """
+    jumps = []
+    calls = []
+    if op == 6:
+        jumps.append(params[0])
+    elif op in (7, 8) and params[1] < 32768:
+        jumps.append(params[1])
+    elif op == 17 and params[0] < 32768:
+        calls.append(params[0])
+    return jumps, calls, op not in stops
+
+
+def analyse(words, entries=(0,)):
+    """
+    Follows control flow through words from the entry points.
+    Returns the program dict.
+    """
+    instructions = {}
+    functions = set(entries)
+    worklist = list(entries)
+    while worklist:
+        address = worklist.pop()
+        while 0 <= address < len(words) and address not in instructions:
+            op = words[address]
+            if op > 21 or address + param_lens[op] >= len(words):
+                break
+            params = tuple(words[address + 1 : address + 1 + param_lens[op]])
+            instructions[address] = (op, params)
+            jumps, calls, falls = successors(address, op, params)
+            worklist += jumps + calls
+            functions.update(calls)
+            if not falls:
+                break
+            address += 1 + len(params)
+    return {'instructions': instructions, 'functions': sorted(functions), 'entries': list(entries), 'size': len(words)}
+
+
+def digest(raw):
+    """
+    Hash the cache is keyed by.
+    """
+    return hashlib.sha256(raw).hexdigest()
+
+
+def load(infile, entries=(0,), use_cache=True):
+    """
+    Returns the program dict for a binary, from the on-disk cache if it's already been analysed.
+    """
+    raw = read_file(infile)
+    key = digest(raw + json.dumps(sorted(entries)).encode())
+    path = os.path.join(cache_dir, key + '.json')
+    if use_cache and os.path.exists(path):
+        with open(path, 'r') as f:
+            cached = json.load(f)
+        cached['instructions'] = {int(address): (op, tuple(params)) for address, (op, params) in cached['instructions'].items()}
+        return cached
+    program = analyse(split_file(raw), entries)
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(program, f)
+    return program
+
+
+def function_of(program):
+    """
+    Maps every instruction to the function it belongs to, by following jumps (but not calls) from each function start.
+    An instruction reachable from more than one function goes to the lowest start.
+    """
+    instructions = program['instructions']
+    owner = {}
+    for start in sorted(program['functions'], reverse=True):
+        worklist = [start]
+        while worklist:
+            address = worklist.pop()
+            if address not in instructions or owner.get(address) == start:
+                continue
+            owner[address] = start
+            op, params = instructions[address]
+            jumps, calls, falls = successors(address, op, params)
+            worklist += jumps
+            if falls:
+                worklist.append(address + 1 + len(params))
+    return owner
+
+
+def blocks(program):
+    """
+    Splits the code into basic blocks.
+    Returns {start: [instruction addresses]} and the edges between blocks as {start: [successor starts]}.
+    """
+    instructions = program['instructions']
+    leaders = set(program['functions'])
+    for address, (op, params) in instructions.items():
+        jumps, calls, falls = successors(address, op, params)
+        leaders.update(jumps)
+        if op in (6, 7, 8, 17, 18, 0):
+            leaders.add(address + 1 + len(params))
+    result = {}
+    edges = {}
+    for start in sorted(leaders):
+        if start not in instructions:
+            continue
+        body = []
+        address = start
+        while address in instructions and (address == start or address not in leaders):
+            body.append(address)
+            op, params = instructions[address]
+            address += 1 + len(params)
+        result[start] = body
+        op, params = instructions[body[-1]]
+        jumps, calls, falls = successors(body[-1], op, params)
+        edges[start] = [x for x in jumps + ([address] if falls else []) if x in instructions]
+    return result, edges
+
+
+def format_instruction(address, op, params):
+    """
+    One listing line, same style as main.disassemble.
+    """
+    data = [str(op)] + [str(x) for x in params]
+    if op == 19 and params[0] < 32768:
+        data[-1] = chr(params[0])
+    return "offset: {} - {} {}".format(address, op_table[op], ' '.join(data))
+
+
+def listing(program, words, outfile):
+    """
+    Writes the disassembly, with each function labelled and everything not reached as code shown as data.
+    """
+    instructions = program['instructions']
+    functions = set(program['functions'])
+    address = 0
+    while address < len(words):
+        if address in instructions:
+            if address in functions:
+                print("\nfunction_{}:".format(address), file=outfile)
+            op, params = instructions[address]
+            print(format_instruction(address, op, params), file=outfile)
+            address += 1 + len(params)
+        else:
+            print("offset: {} - data {}".format(address, words[address]), file=outfile)
+            address += 1
+
+
+def to_dot(program, outfile):
+    """
+    Writes the control flow graph in graphviz dot format, one node per basic block, grouped by function.
+    """
+    instructions = program['instructions']
+    bodies, edges = blocks(program)
+    owner = function_of(program)
+    print("digraph cfg {\n  node [shape=box fontname=monospace];", file=outfile)
+    for function in program['functions']:
+        members = [start for start in bodies if owner.get(start) == function]
+        if not members:
+            continue
+        print("  subgraph cluster_{0} {{\n    label=\"function_{0}\";".format(function), file=outfile)
+        for start in members:
+            text = '\\l'.join(format_instruction(x, *instructions[x]).replace('"', '\\"') for x in bodies[start])
+            print("    b{} [label=\"{}\\l\"];".format(start, text), file=outfile)
+        print("  }", file=outfile)
+    for start, targets in edges.items():
+        for target in targets:
+            print("  b{} -> b{};".format(start, target), file=outfile)
+    print("}", file=outfile)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Recursive descent disassembler.")
+    parser.add_argument('-f', '--file', dest="input_file", help="Input (challenge).bin", metavar="INFILE", required=True)
+    parser.add_argument('-o', '--output', dest="output_file", help="Listing file to write, stdout if not given", metavar="FILE", required=False)
+    parser.add_argument('-g', '--cfg', dest="cfg_file", help="Write the control flow graph as graphviz dot", metavar="DOT", required=False)
+    parser.add_argument('-e', '--entry', dest="entries", help="Extra entry point, for code only reached indirectly", metavar="ADDR", type=int, action='append', default=[])
+    parser.add_argument('--no-cache', dest="use_cache", help="Don't read or write the analysis cache", action='store_false')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    program = load(options.input_file, [0] + options.entries, options.use_cache)
+    words = split_file(read_file(options.input_file))
+    if options.output_file:
+        with open(options.output_file, 'w') as f:
+            listing(program, words, f)
+    else:
+        listing(program, words, sys.stdout)
+    if options.cfg_file:
+        with open(options.cfg_file, 'w') as f:
+            to_dot(program, f)
+    print(len(program['instructions']), "instructions in", len(program['functions']), "functions", file=sys.stderr)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Breadth first exploration of the adventure.
+Every point where the VM blocks on 'in' is a node, and the commands tried from it are the edges. A command runs
+headlessly from a copy of the node's state up to the next 'in', and the state it lands in is only explored further if
+it hasn't been seen before.
+States are told apart by a hash over memory, registers and stack. Memory is hashed a page at a time, and a decode
+cache that notes which pages get written lets each new state rehash only the pages its command touched. Scratch
+space, like the buffer the last command was typed into, can be left out of the hash, and so can the registers, so that
+the same place reached by different commands counts as one state.
+Commands come from a vocabulary of templates, where '{exit}' is filled in with each exit listed in the text that led to
+the node, and '{item}' with every item seen listed anywhere so far.
+"""
+
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import deque
+import checkpoint
+import disasm
+import image
+from checkpoint import NUM_PAGES, PAGE_WORDS, to_bytes
+from vm import DecodeCache, load_memory
+from headless import OutOfBudget, ScriptedInput, BufferedOutput, run_headless
+
+vocabulary = ['{exit}', 'take {item}', 'use {item}', 'look {item}', 'inv']
+
+
+class TrackingCache(DecodeCache):
+    """
+    Decode cache that also marks which pages of memory get written.
+    """
+    def __init__(self, memory, stdin=None, stdout=None):
+        super().__init__(memory, stdin, stdout)
+        self.dirty = bytearray(NUM_PAGES)
+
+    def invalidate(self, location):
+        self.dirty[location // PAGE_WORDS] = 1
+        super().invalidate(location)
+
+
+def parse_range(text):
+    """
+    Parses 'start-end' (inclusive) or a single address into a range.
+    """
+    start, _, end = text.partition('-')
+    return range(int(start), int(end or start) + 1)
+
+
+def listed(text):
+    """
+    Picks the '- thing' lists out of the game's text.
+    Returns (exits, items): lists under a header mentioning exits, and under any other header.
+    """
+    exits = []
+    items = []
+    current = None
+    for line in text.split('\n'):
+        if line.endswith(':'):
+            current = exits if 'exit' in line else items
+        elif line.startswith('- ') and current is not None:
+            current.append(line[2:].strip())
+        else:
+            current = None
+    return exits, items
+
+
+class Explorer:
+    """
+    Explores from a starting state. Nodes waiting to be expanded are (path, memory, stack, registers, offset, page
+    digests, text that led there). Only the frontier keeps its memory, everything already seen is just a hash.
+    """
+    def __init__(self, memory, stack, registers, offset, vocabulary=vocabulary, max_depth=8, max_states=10000,
+                 ignore=(), hash_registers=True, program=None, budget=10000000):
+        self.vocabulary = vocabulary
+        # Instructions a command gets to reach the next prompt in, so one that sends the game into a loop is a dead end.
+        self.budget = budget
+        self.max_depth = max_depth
+        self.max_states = max_states
+        self.hash_registers = hash_registers
+        # Words left out of the hash, by page.
+        self.ignore = {}
+        for addresses in ignore:
+            for address in addresses:
+                self.ignore.setdefault(address // PAGE_WORDS, []).append(address % PAGE_WORDS)
+        # Decoded once for the starting memory, and cloned for every run, patched where memory has moved on.
+        # program is the image.Image memory was loaded from, when starting from a binary, and already knows the code.
+        self.root = TrackingCache(memory)
+        if program is not None:
+            program.warm(self.root)
+        else:
+            for address in disasm.analyse(memory, [offset])['instructions']:
+                self.root[address]
+        self.root_pages = [self.page_digest(memory, page) for page in range(NUM_PAGES)]
+        self.items = []
+        self.seen_lines = set()
+        self.discoveries = []
+        self.seen = set()
+        self.frontier = deque()
+        self.runs = 0
+        node = self.step(((), memory, stack, registers, offset, self.root_pages, ''), None)
+        if node is not None:
+            self.frontier.append(node)
+
+    def page_digest(self, memory, page):
+        words = memory[page * PAGE_WORDS : (page + 1) * PAGE_WORDS]
+        for index in self.ignore.get(page, ()):
+            words[index] = 0
+        return hashlib.sha1(to_bytes(words)).digest()
+
+    def state_hash(self, pages, stack, registers, offset):
+        """
+        Hash of a state from its page digests, without touching memory itself.
+        """
+        state = hashlib.sha1(b''.join(pages))
+        state.update(to_bytes((registers if self.hash_registers else []) + [offset]))
+        state.update(to_bytes(stack))
+        return state.hexdigest()
+
+    def cache_for(self, memory, pages):
+        """
+        Returns a decode cache for memory, dropping whatever was decoded from words that differ from the start.
+        """
+        decoded = self.root.clone(memory)
+        for page, (digest, root_digest) in enumerate(zip(pages, self.root_pages)):
+            if digest != root_digest or page in self.ignore:
+                for location in range(page * PAGE_WORDS, (page + 1) * PAGE_WORDS):
+                    if memory[location] != self.root.memory[location]:
+                        decoded.invalidate(location)
+        decoded.dirty = bytearray(NUM_PAGES)
+        return decoded
+
+    def step(self, node, command):
+        """
+        Runs command from node up to the next input, or with no command from wherever node is up to the first one.
+        Returns the new node, or None if the VM halted, ran out of budget, or the state has been seen before.
+        """
+        path, memory, stack, registers, offset, pages, text = node
+        memory = memory[:]
+        stack = stack[:]
+        registers = registers[:]
+        decoded = self.cache_for(memory, pages)
+        output = BufferedOutput(line_buffered=False, keep=True)
+        lines = [] if command is None else [command]
+        self.runs += 1
+        path = path if command is None else path + (command,)
+        try:
+            offset, halt, reason = run_headless(memory, stack, registers, offset, ScriptedInput(lines), output, decoded,
+                                                self.budget)
+        except OutOfBudget:
+            self.discover(output.getvalue(), path)
+            return None
+        text = output.getvalue()
+        self.discover(text, path)
+        if halt:
+            return None
+        pages = list(pages)
+        for page, dirty in enumerate(decoded.dirty):
+            if dirty:
+                pages[page] = self.page_digest(memory, page)
+        key = self.state_hash(pages, stack, registers, offset)
+        if key in self.seen:
+            return None
+        self.seen.add(key)
+        return path, memory, stack, registers, offset, pages, text
+
+    def discover(self, text, path):
+        """
+        Notes lines of output not seen before, and any new items listed in them.
+        """
+        for line in text.split('\n'):
+            line = line.strip()
+            if line and line not in self.seen_lines:
+                self.seen_lines.add(line)
+                self.discoveries.append({'text': line, 'path': list(path)})
+                print("{:>6}  {}  <- {}".format(len(self.seen), line, ' / '.join(path)))
+        for item in listed(text)[1]:
+            if item not in self.items:
+                self.items.append(item)
+
+    def commands(self, text):
+        """
+        Expands the vocabulary for a node reached with text.
+        """
+        exits = listed(text)[0]
+        commands = []
+        for template in self.vocabulary:
+            if '{exit}' in template:
+                commands += [template.format(exit=name) for name in exits]
+            elif '{item}' in template:
+                commands += [template.format(item=name) for name in self.items]
+            else:
+                commands.append(template)
+        return commands
+
+    def run(self):
+        """
+        Explores breadth first until the frontier runs out or a limit is hit.
+        """
+        while self.frontier and len(self.seen) < self.max_states:
+            node = self.frontier.popleft()
+            if len(node[0]) >= self.max_depth:
+                continue
+            for command in self.commands(node[6]):
+                child = self.step(node, command)
+                if child is not None:
+                    self.frontier.append(child)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Explores the adventure's states breadth first.")
+    parser.add_argument('-f', '--file', dest="input_file", help="Input (challenge).bin", metavar="INFILE", required=False)
+    parser.add_argument('-x', '--checkpoint', dest="checkpoint", help="Checkpoint to start from instead of the start of the binary", metavar="CHECKPOINT", required=False)
+    parser.add_argument('-v', '--vocabulary', dest="vocabulary_file", help="Command templates to try, one per line, with {exit} and {item} filled in", metavar="FILE", required=False)
+    parser.add_argument('-d', '--depth', dest="depth", help="Most commands to go from the start", type=int, default=8)
+    parser.add_argument('-n', '--max-states', dest="max_states", help="Stop after this many distinct states", type=int, default=10000)
+    parser.add_argument('-b', '--budget', dest="budget", help="Instructions a command gets to reach the next prompt in, before it's given up on", type=int, default=10000000)
+    parser.add_argument('-i', '--ignore', dest="ignore", help="Memory to leave out of state hashes, as START-END or one address", metavar="RANGE", type=parse_range, action='append', default=[])
+    parser.add_argument('--no-registers', dest="hash_registers", help="Leave the registers out of state hashes", action='store_false')
+    parser.add_argument('-o', '--output', dest="output_file", help="Write the discovered text, with the commands that first led to each line, as JSON", metavar="FILE", required=False)
+    args = parser.parse_args()
+    if not args.input_file and not args.checkpoint:
+        parser.error("one of -f/--file or -x/--checkpoint is required")
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    program = None
+    if options.checkpoint:
+        state = checkpoint.load(options.checkpoint)
+        memory, stack, registers, offset = load_memory(state['memory']), state['stack'], state['registers'], state['offset']
+    else:
+        program = image.open_image(options.input_file)
+        memory, stack, registers, offset = program.memory(), [], [0] * 8, 0
+    words = vocabulary
+    if options.vocabulary_file:
+        with open(options.vocabulary_file) as f:
+            words = [line.strip() for line in f if line.strip()]
+    started = time.time()
+    explorer = Explorer(memory, stack, registers, offset, words, options.depth, options.max_states,
+                        options.ignore, options.hash_registers, program, options.budget)
+    explorer.run()
+    print("{} distinct states from {} runs in {:.1f}s, {} lines of text, items: {}".format(
+        len(explorer.seen), explorer.runs, time.time() - started, len(explorer.seen_lines), ', '.join(explorer.items)),
+        file=sys.stderr)
+    if options.output_file:
+        with open(options.output_file, 'w') as f:
+            json.dump({'states': len(explorer.seen), 'items': explorer.items, 'discoveries': explorer.discoveries}, f, indent=1)
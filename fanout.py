@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Runs many input scripts from the same starting state at once, one per worker process.
+The state is loaded and its reachable code decoded once, in the parent, before the pool is forked, so every worker
+starts with both already in its (copy-on-write) memory instead of parsing a checkpoint and decoding code itself.
+Starting from a binary, what's reachable comes from its cached image (see image.py) rather than being analysed again.
+Each script gets its own copy of memory and of the decode cache, since scripts can rewrite both.
+"""
+
+import sys
+import json
+import argparse
+import multiprocessing
+import checkpoint
+import disasm
+import image
+from vm import DecodeCache, load_memory
+from headless import ScriptedInput, BufferedOutput, run_headless
+
+# The state workers start from, set before the pool is forked: (memory, stack, registers, offset, decode cache).
+base = None
+
+
+def prepare(memory, stack, registers, offset, program=None):
+    """
+    Sets the base state and decodes the code reachable from it ahead of time.
+    program is the image.Image memory was loaded from, if it's the start of a binary.
+    """
+    global base
+    decoded = DecodeCache(memory)
+    if program is not None:
+        program.warm(decoded)
+    else:
+        for address in disasm.analyse(memory, [offset])['instructions']:
+            decoded[address]
+    base = (memory, stack, registers, offset, decoded)
+
+
+def run_script(task):
+    """
+    Runs one named script from the base state in a worker.
+    Returns the result dict: the transcript, why and where it stopped, and the hash of the state it ended in.
+    """
+    name, lines = task
+    memory, stack, registers, offset, decoded = base
+    memory = memory[:]
+    stack = stack[:]
+    registers = registers[:]
+    output = BufferedOutput(line_buffered=False, keep=True)
+    offset, halt, reason = run_headless(memory, stack, registers, offset, ScriptedInput(lines), output,
+                                        decoded.clone(memory))
+    return {'script': name, 'transcript': output.getvalue(), 'halted': halt, 'reason': reason, 'offset': offset,
+            'hash': checkpoint.state_digest(memory, stack, registers, offset)}
+
+
+def run_all(scripts, workers=None):
+    """
+    Runs a {name: lines} dict of scripts across a pool of forked workers, yielding results as they finish.
+    prepare has to have been called first.
+    """
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers) as pool:
+        yield from pool.imap_unordered(run_script, scripts.items())
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Runs input scripts in parallel from one starting state.")
+    parser.add_argument('-f', '--file', dest="input_file", help="Input (challenge).bin", metavar="INFILE", required=False)
+    parser.add_argument('-x', '--checkpoint', dest="checkpoint", help="Checkpoint to start from instead of the start of the binary", metavar="CHECKPOINT", required=False)
+    parser.add_argument('-j', '--jobs', dest="jobs", help="Worker processes, defaults to the number of cores", type=int, required=False)
+    parser.add_argument('-o', '--output', dest="output_file", help="Write the results, transcripts included, as JSON", metavar="FILE", required=False)
+    parser.add_argument('scripts', help="Input scripts to run, one command per line", metavar="SCRIPT", nargs='+')
+    args = parser.parse_args()
+    if not args.input_file and not args.checkpoint:
+        parser.error("one of -f/--file or -x/--checkpoint is required")
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    program = None
+    if options.checkpoint:
+        state = checkpoint.load(options.checkpoint)
+        memory, stack, registers, offset = load_memory(state['memory']), state['stack'], state['registers'], state['offset']
+    else:
+        program = image.open_image(options.input_file)
+        memory, stack, registers, offset = program.memory(), [], [0] * 8, 0
+    prepare(memory, stack, registers, offset, program)
+    scripts = {}
+    for path in options.scripts:
+        with open(path) as f:
+            scripts[path] = f.readlines()
+    results = []
+    for result in run_all(scripts, options.jobs):
+        results.append(result)
+        last = result['transcript'].rstrip('\n').rsplit('\n', 1)[-1]
+        print("{}  {}  {} at {}  | {}".format(result['hash'][:12], result['script'], result['reason'], result['offset'], last))
+    states = {result['hash'] for result in results}
+    print(len(results), "scripts ended in", len(states), "distinct states", file=sys.stderr)
+    if options.output_file:
+        results.sort(key=lambda result: result['script'])
+        with open(options.output_file, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+Headless runs: the VM's input comes from a script of adventure commands instead of the terminal, and its output is
+buffered and passed on a line at a time. A run can stop at a numbered command or a named input point in the script,
+and leave a checkpoint there.
+"""
+
+import sys
+import checkpoint
+from vm import DecodeCache, Stop, batch_size, run_batch
+
+
+class ScriptedInput:
+    """
+    Feeds the VM's 'in' instruction from a list of adventure commands instead of the terminal.
+    Lines starting with '#' are comments, except '#@ name', which marks a named input point before the next command.
+    Reading past stop_at, either a number of commands or an input point name, or past the end of the script,
+    raises Stop before the 'in' instruction changes anything.
+    """
+    def __init__(self, lines, stop_at=None):
+        self.commands = []
+        self.points = {}
+        for line in lines:
+            line = line.rstrip('\n')
+            if line.startswith('#@'):
+                self.points[line[2:].strip()] = len(self.commands)
+            elif not line.startswith('#'):
+                self.commands.append(line)
+        self.text = ''.join(command + '\n' for command in self.commands)
+        self.pos = 0
+        self.commands_read = 0
+        self.stop_after = None
+        self.stop_at(stop_at)
+
+    def stop_at(self, point):
+        """
+        Sets where to stop, as a number of commands or the name of an input point. None runs the whole script.
+        Raises ValueError for a name the script doesn't have.
+        """
+        if point is None or isinstance(point, int):
+            self.stop_after = point
+        elif point.isdigit():
+            self.stop_after = int(point)
+        elif point in self.points:
+            self.stop_after = self.points[point]
+        else:
+            raise ValueError("no input point named '{}' in the script".format(point))
+
+    def read(self, size=1):
+        if self.stop_after is not None and self.commands_read >= self.stop_after:
+            raise Stop("stopped after command {}".format(self.commands_read))
+        if self.pos >= len(self.text):
+            raise Stop("end of script after command {}".format(self.commands_read))
+        chunk = self.text[self.pos : self.pos + size]
+        self.pos += len(chunk)
+        self.commands_read += chunk.count('\n')
+        return chunk
+
+
+class BufferedOutput:
+    """
+    Collects the VM's output, and passes it on to target a whole line at a time, or only when flushed if
+    line_buffered is off. Everything written is also kept in transcript if keep is set.
+    """
+    def __init__(self, target=None, line_buffered=True, keep=False):
+        self.target = target
+        self.line_buffered = line_buffered
+        self.parts = []
+        self.transcript = [] if keep else None
+
+    def write(self, text):
+        self.parts.append(text)
+        if self.line_buffered and '\n' in text:
+            self.flush()
+
+    def flush(self):
+        text = ''.join(self.parts)
+        self.parts = []
+        if self.transcript is not None:
+            self.transcript.append(text)
+        if self.target is not None:
+            self.target.write(text)
+            self.target.flush()
+
+    def pending(self):
+        """
+        Returns what's been written since the last flush.
+        """
+        return ''.join(self.parts)
+
+    def getvalue(self):
+        """
+        Returns everything written so far, flushed or not. Only the output since the last flush is still around
+        without keep, so then it raises ValueError rather than return part of it.
+        """
+        if self.transcript is None:
+            raise ValueError("output isn't kept, only what's pending since the last flush")
+        return ''.join(self.transcript) + self.pending()
+
+
+class OutOfBudget(Stop):
+    """
+    Raised by run_headless when the VM uses up its instruction limit without halting or stopping for input.
+    """
+
+
+def run_headless(memory, stack, registers, offset, script, output, decoded=None, limit=None):
+    """
+    Runs the VM with scripted input and buffered output until it halts or the script stops it.
+    With limit, raises OutOfBudget instead once that many instructions have run, counting a fused run as one.
+    Returns the offset to resume from, whether the VM halted, and why it stopped.
+    """
+    if decoded is None:
+        decoded = DecodeCache(memory)
+    decoded.stdin = script
+    decoded.stdout = output
+    halt = False
+    stopped = False
+    reason = "halted"
+    done = 0
+    try:
+        while not halt and (limit is None or done < limit):
+            count = batch_size if limit is None else min(batch_size, limit - done)
+            offset, halt = run_batch(memory, stack, registers, offset, decoded, count)
+            done += count
+    except Stop as stop:
+        offset = stop.offset
+        stopped = True
+        reason = str(stop)
+    output.flush()
+    if not halt and not stopped:
+        out = OutOfBudget("no input or halt within {} instructions".format(limit))
+        out.offset = offset
+        raise out
+    return offset, halt, reason
+
+
+def replay(memory, stack, registers, offset, lines, stop_at=None, checkpoint_file=None, compress=False, target=sys.stdout):
+    """
+    Replays a list of commands headlessly, printing output by the line, and checkpoints where it stopped if asked.
+    """
+    script = ScriptedInput(lines, stop_at)
+    output = BufferedOutput(target)
+    offset, halt, reason = run_headless(memory, stack, registers, offset, script, output)
+    if checkpoint_file and not halt:
+        checkpoint.save(checkpoint_file, memory, stack, registers, offset, compress=compress)
+    return offset, halt, reason
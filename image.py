@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Pre-decoded program images, cached on disk so a binary only gets parsed and analysed once.
+An image is one flat file that can be mapped straight into memory:
+    header: magic, version, size of the binary in words, number of instructions and of functions
+    memory: all 32768 words, little-endian, zero padded past the end of the binary
+    code map: a byte per word, 0 for data, 1 for the start of an instruction, 2 for one of its operands
+    instructions: the start of every instruction reachable from 0, as words
+    functions: the start of every function, as words
+The sections are viewed in place through the map, so opening an image costs a hash of the binary and nothing else,
+and worker processes mapping the same file share its pages. Images are keyed by the sha256 of the binary, so editing
+the binary just means a different image, and one built by an older version of this module gets rebuilt.
+"""
+
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import argparse
+import tempfile
+from array import array
+import disasm
+from vm import read_file, split_file, load_memory, param_lens
+
+cache_dir = '.image_cache'
+MAGIC = b'SYNI'
+VERSION = 1
+header = struct.Struct('<4sHxxIII')
+HEADER_SIZE = 32
+DATA = 0
+START = 1
+OPERAND = 2
+
+
+def build(raw):
+    """
+    Parses and analyses a binary.
+    Returns its image, as bytes.
+    """
+    words = split_file(raw)
+    memory = load_memory(words)
+    program = disasm.analyse(words)
+    code_map = bytearray(32768)
+    instructions = array('H', sorted(program['instructions']))
+    for address in instructions:
+        code_map[address] = START
+        length = param_lens[memory[address]]
+        code_map[address + 1 : address + 1 + length] = bytes([OPERAND]) * length
+    functions = array('H', program['functions'])
+    if sys.byteorder == 'big':
+        for section in (memory, instructions, functions):
+            section.byteswap()
+    head = header.pack(MAGIC, VERSION, len(words), len(instructions), len(functions))
+    return b''.join([head.ljust(HEADER_SIZE, b'\0'), memory.tobytes(), bytes(code_map), instructions.tobytes(),
+                     functions.tobytes()])
+
+
+class Image:
+    """
+    A program image over any buffer, usually a read only map of a cached image file.
+    words, code_map, instructions and functions are memoryviews into it, with words little-endian as stored.
+    """
+    def __init__(self, data):
+        magic, version, size, num_instructions, num_functions = header.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version {} program image".format(VERSION))
+        self.data = data
+        self.size = size
+        view = memoryview(data)
+        start = HEADER_SIZE
+        self.words = view[start : start + 65536].cast('H')
+        start += 65536
+        self.code_map = view[start : start + 32768]
+        start += 32768
+        self.instructions = view[start : start + 2 * num_instructions].cast('H')
+        start += 2 * num_instructions
+        self.functions = view[start : start + 2 * num_functions].cast('H')
+        self.views = [view, self.words, self.code_map, self.instructions, self.functions]
+
+    def memory(self):
+        """
+        Returns a fresh, writable memory array for the VM to run in.
+        """
+        # Copied in one go from the bytes, where array('H', self.words) would go a word at a time.
+        memory = array('H')
+        with self.words.cast('B') as raw:
+            memory.frombytes(raw)
+        if sys.byteorder == 'big':
+            memory.byteswap()
+        return memory
+
+    def warm(self, decoded):
+        """
+        Decodes every reachable instruction into a decode cache ahead of time.
+        """
+        instructions = array('H', self.instructions)
+        if sys.byteorder == 'big':
+            instructions.byteswap()
+        for address in instructions:
+            decoded[address]
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def map_file(path):
+    """
+    Returns the Image in a cached image file, mapped read only.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return Image(data)
+    except (ValueError, struct.error):
+        data.close()
+        raise
+
+
+def open_image(infile, use_cache=True):
+    """
+    Returns the Image for a binary, mapped from the cache if it's been built before, and built (and cached) if not.
+    """
+    raw = read_file(infile)
+    path = os.path.join(cache_dir, disasm.digest(raw) + '.img')
+    if use_cache:
+        try:
+            return map_file(path)
+        except (OSError, ValueError, struct.error):
+            pass
+    image = build(raw)
+    if use_cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written to the side and moved into place, so another process never maps half an image.
+            handle, temporary = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as f:
+                f.write(image)
+            os.replace(temporary, path)
+            return map_file(path)
+        except OSError:
+            pass
+    return Image(image)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Builds or inspects the cached program image for a binary.")
+    parser.add_argument('input_file', help="Input (challenge).bin", metavar="INFILE")
+    parser.add_argument('-r', '--rebuild', dest="rebuild", help="Build the image again even if it's cached", action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    if options.rebuild:
+        path = os.path.join(cache_dir, disasm.digest(read_file(options.input_file)) + '.img')
+        if os.path.exists(path):
+            os.remove(path)
+    image = open_image(options.input_file)
+    print("{} words, {} instructions, {} functions, {} words of data".format(
+        image.size, len(image.instructions), len(image.functions), bytes(image.code_map[:image.size]).count(DATA)))
+    image.close()
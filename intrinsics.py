@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""
+Host side replacements for guest routines.
+An intrinsic is registered at the address a guest routine starts at. When execution gets there, the VM calls
+function(registers, stack, memory) instead and then does the routine's 'ret' itself.
+Intrinsics that touch memory should go through vm.set_value with the decode cache, same as the handlers do.
+"""
+
+import importlib
+import json
+
+
+def memoized(*reads):
+    """
+    Memoizes an intrinsic on the registers it reads.
+    The wrapped function takes those register values and returns a dict of register writes, which gets cached and
+    applied again on any later call with the same inputs.
+    """
+    def wrap(function):
+        cache = {}
+
+        def intrinsic(registers, stack, memory):
+            key = tuple([registers[idx] for idx in reads])
+            writes = cache.get(key)
+            if writes is None:
+                writes = cache[key] = function(*key)
+            for idx, value in writes.items():
+                registers[idx] = value
+        intrinsic.__name__ = function.__name__
+        intrinsic.__doc__ = function.__doc__
+        intrinsic.cache = cache
+        return intrinsic
+    return wrap
+
+
+@memoized(0, 1, 7)
+def teleporter_confirm(r0, r1, r7):
+    """
+    The confirmation routine at 6027, run on the host with the row by row solver from teleport_shenanigans.
+    Leaves its result in reg0, and reg1 one less than it, same as the guest's last base case does.
+    """
+    # Imported here rather than at the top, so only runs that use it pay for the import.
+    import teleport_shenanigans
+    result = teleport_shenanigans.solve(r0, r1, r7)
+    return {0: result, 1: (result + 32767) % 32768}
+
+
+def skip_teleporter_check(registers, stack, memory):
+    """
+    What teleporter tampering used to hard-code: pretend the confirmation routine came back with 6 for the right reg7.
+    """
+    registers[0] = 6
+    registers[1] = 5
+    registers[7] = 25734
+    print("Teleport check skipped.")
+
+
+# The built in intrinsics, loaded with the spec 'intrinsics'.
+intrinsics = {6027: teleporter_confirm}
+
+
+def resolve(name):
+    """
+    Returns the function named by 'module:function'.
+    """
+    module_name, function_name = name.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def load(spec):
+    """
+    Returns a {address: function} dict of intrinsics.
+    spec is either a JSON file mapping addresses to 'module:function' names, or the name of a module with an
+    'intrinsics' dict of its own.
+    """
+    if spec.endswith('.json'):
+        with open(spec, 'r') as f:
+            config = json.load(f)
+        return {int(address): resolve(name) for address, name in config.items()}
+    return dict(importlib.import_module(spec).intrinsics)
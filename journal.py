@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+Time travel: an undo journal of everything each instruction changes, so execution can be stepped backwards.
+Before an instruction runs, whatever it's about to overwrite is noted from its op and operands: the register or memory
+word it writes with the old value there, and the value it pops off the stack, or just that it pushes. Those go into a
+flat list of ints as (kind, where, old value) triples, followed by an (offset, number of triples, 0) trailer, so
+recording costs one extend per instruction and never a copy of the state. Once a segment is done its list gets packed
+into an array, at four bytes an int.
+The journal is split into segments, each starting with a keyframe, a full copy of the state. Only so many segments are
+kept, which bounds the memory it takes, and going back a long way restores a keyframe instead of undoing every
+instruction since. Intrinsics can change anything, so a new segment is started right before one runs.
+Output already written and input already read can't be taken back, so running forward again over an 'in' reads new
+input.
+"""
+
+from array import array
+from vm import HALT, Interrupted, Stop
+
+REGISTER = 1
+MEMORY = 2
+PUSH = 3
+POP = 4
+# Ops whose first operand is where they write their result.
+writes_first = {1, 3, 4, 5, 9, 10, 11, 12, 13, 14, 15, 20}
+
+
+class Journal:
+    """
+    Undo journal, as a list of [start position, keyframe, log] segments. Positions count instructions run.
+    A keyframe is (memory, stack, registers, offset) as they were at the start of its segment.
+    """
+    def __init__(self, interval=100000, keep=10):
+        self.interval = interval
+        self.keep = keep
+        self.segments = []
+        self.position = 0
+        self.count = 0
+
+    def keyframe(self, memory, stack, registers, offset):
+        """
+        Starts a new segment from the current state, dropping the oldest one if there are too many.
+        """
+        if self.segments:
+            self.segments[-1][2] = array('i', self.segments[-1][2])
+        self.segments.append([self.position, (array('H', memory), stack[:], registers[:], offset), []])
+        self.count = 0
+        if len(self.segments) > self.keep:
+            del self.segments[0]
+
+    def prepare(self, memory, stack, registers, offset, params, op, decoded):
+        """
+        Returns the undo triples for the instruction about to run at offset, taking a keyframe first if one is due.
+        """
+        if not self.segments or self.count >= self.interval or (offset in decoded.intrinsics and self.count):
+            self.keyframe(memory, stack, registers, offset)
+        found = []
+        if offset in decoded.intrinsics:
+            return found
+        if op in writes_first:
+            where = params[0]
+            if where > 32767:
+                found += [REGISTER, where - 32768, registers[where - 32768]]
+            else:
+                found += [MEMORY, where, memory[where]]
+        elif op == 16:
+            where = params[0] if params[0] < 32768 else registers[params[0] - 32768]
+            # Like set_value, an address past memory names a register.
+            if where > 32767:
+                found += [REGISTER, where - 32768, registers[where - 32768]]
+            else:
+                found += [MEMORY, where, memory[where]]
+        if op in (2, 17):
+            found += [PUSH, 0, 0]
+        elif op in (3, 18) and stack:
+            found += [POP, 0, stack[-1]]
+        return found
+
+    def current(self):
+        """
+        Returns the log being added to, unpacking it again if it's been packed.
+        """
+        log = self.segments[-1][2]
+        if not isinstance(log, list):
+            log = self.segments[-1][2] = list(log)
+        return log
+
+    def commit(self, offset, found):
+        """
+        Adds the instruction at offset, once it's run, with the undo triples prepare gave for it.
+        """
+        log = self.current()
+        log.extend(found)
+        log.extend((offset, len(found) // 3, 0))
+        self.count += 1
+        self.position += 1
+
+    def run_batch(self, memory, stack, registers, offset, decoded, count):
+        """
+        Same as vm.run_batch, but journaling each instruction as it goes. This is prepare and commit inlined, with
+        each instruction's triples and trailer added in one go, and taken back off if it fails part way.
+        """
+        intrinsics = decoded.intrinsics
+        done = 0
+        try:
+            while done < count:
+                if not self.segments or self.count >= self.interval:
+                    self.keyframe(memory, stack, registers, offset)
+                log = self.current()
+                extend = log.extend
+                chunk = min(count - done, self.interval - self.count)
+                ran = 0
+                try:
+                    for ran in range(chunk):
+                        handler, params, op = decoded[offset]
+                        if op in writes_first:
+                            where = params[0]
+                            if where > 32767:
+                                if op == 3:
+                                    entry = (POP, 0, stack[-1] if stack else 0, REGISTER, where - 32768, registers[where - 32768], offset, 2, 0)
+                                else:
+                                    entry = (REGISTER, where - 32768, registers[where - 32768], offset, 1, 0)
+                            elif op == 3:
+                                entry = (POP, 0, stack[-1] if stack else 0, MEMORY, where, memory[where], offset, 2, 0)
+                            else:
+                                entry = (MEMORY, where, memory[where], offset, 1, 0)
+                        elif op == 16:
+                            where = params[0] if params[0] < 32768 else registers[params[0] - 32768]
+                            if where > 32767:
+                                entry = (REGISTER, where - 32768, registers[where - 32768], offset, 1, 0)
+                            else:
+                                entry = (MEMORY, where, memory[where], offset, 1, 0)
+                        elif op == 2 or op == 17:
+                            entry = (PUSH, 0, 0, offset, 1, 0)
+                        elif op == 18:
+                            if offset in intrinsics:
+                                # Needs a keyframe of its own, so leave it to the general path.
+                                break
+                            entry = (POP, 0, stack[-1] if stack else 0, offset, 1, 0)
+                        else:
+                            entry = (offset, 0, 0)
+                        extend(entry)
+                        try:
+                            next_offset = handler(memory, stack, registers, offset, params, decoded)
+                        except BaseException:
+                            del log[len(log) - len(entry):]
+                            raise
+                        if next_offset == HALT:
+                            ran += 1
+                            return offset, True
+                        offset = next_offset
+                    else:
+                        ran = chunk
+                finally:
+                    # ran is how many instructions finished, however the loop was left.
+                    self.count += ran
+                    self.position += ran
+                    done += ran
+                if ran < chunk:
+                    handler, params, op = decoded[offset]
+                    found = self.prepare(memory, stack, registers, offset, params, op, decoded)
+                    next_offset = handler(memory, stack, registers, offset, params, decoded)
+                    self.commit(offset, found)
+                    done += 1
+                    offset = next_offset
+        except Interrupted:
+            pass
+        except Stop as stop:
+            stop.offset = offset
+            raise
+        return offset, False
+
+    def restore(self, segment, memory, stack, registers, decoded):
+        """
+        Puts the state back to a segment's keyframe, in place, and empties its log.
+        Returns the offset to carry on from.
+        """
+        start, (saved_memory, saved_stack, saved_registers, offset), log = segment
+        memory[:] = saved_memory
+        stack[:] = saved_stack
+        registers[:] = saved_registers
+        decoded.reset()
+        del log[:]
+        self.position = start
+        self.count = 0
+        return offset
+
+    def undo(self, memory, stack, registers, decoded):
+        """
+        Undoes the last instruction in the current segment.
+        Returns the offset it ran at, which is where to carry on from.
+        """
+        log = self.segments[-1][2]
+        offset, number, _ = log[-3:]
+        end = len(log) - 3
+        begin = end - 3 * number
+        for idx in range(end - 3, begin - 1, -3):
+            kind, where, old = log[idx : idx + 3]
+            if kind == REGISTER:
+                registers[where] = old
+            elif kind == MEMORY:
+                memory[where] = old
+                decoded.invalidate(where)
+            elif kind == PUSH:
+                stack.pop()
+            else:
+                stack.append(old)
+        del log[begin:]
+        self.count -= 1
+        self.position -= 1
+        return offset
+
+    def back(self, steps, memory, stack, registers, decoded):
+        """
+        Steps back up to steps instructions, as far as the journal goes.
+        Returns the offset to carry on from, or None if there was nothing to go back over.
+        """
+        if not self.segments:
+            return None
+        target = max(self.position - steps, self.segments[0][0])
+        offset = None
+        while self.position > target:
+            segment = self.segments[-1]
+            if target <= segment[0]:
+                offset = self.restore(segment, memory, stack, registers, decoded)
+                if target < segment[0]:
+                    # The previous segment ends in the state this one starts from, so carry on undoing there.
+                    self.segments.pop()
+                    self.count = self.interval
+            else:
+                offset = self.undo(memory, stack, registers, decoded)
+        return offset
+
+    def steps_to_write(self, address):
+        """
+        Returns how many instructions back the last write to address was, a register if it's over 32767, or None if
+        it isn't in the journal.
+        """
+        kind, where = (REGISTER, address - 32768) if address > 32767 else (MEMORY, address)
+        steps = 0
+        for segment in reversed(self.segments):
+            log = segment[2]
+            end = len(log)
+            while end:
+                number = log[end - 2]
+                begin = end - 3 - 3 * number
+                steps += 1
+                for idx in range(begin, end - 3, 3):
+                    if log[idx] == kind and log[idx + 1] == where:
+                        return steps
+                end = begin
+        return None
+
+    def available(self):
+        """
+        Returns how many instructions back the journal reaches.
+        """
+        return self.position - self.segments[0][0] if self.segments else 0
@@ -1,80 +1,27 @@
 #!/usr/bin/env python
 
-from struct import unpack
+from array import array
+import os
 import sys
-import json
+import signal
 import argparse
+import checkpoint
+import intrinsics
+from tracer import Tracer
+from vm import (Break, DecodeCache, Interrupted, batch_size, load_memory, load_program, op_in, op_table, param_lens,
+                read_file, run_batch, run_inner, split_file)
 
-op_table = {0: 'halt', 1: 'set', 2: 'push', 3: 'pop', 4: 'eq', 5: 'gt',6 : 'jmp', 7: 'jt', 8: 'jf', 9: 'add', 10: 'mult', 11: 'mod', 12: 'and', 13: 'or', 14: 'not', 15: 'rmem', 16: 'wmem', 17: 'call', 18: 'ret', 19: 'out', 20: 'in', 21: 'noop'}
-param_lens = [0, 2, 1, 1, 3, 3, 1, 2, 2, 3, 3, 3, 3, 3, 2, 2, 2, 1, 0, 1, 1, 0]
+# Where periodic checkpoints go, a full snapshot when the run starts and then a delta against it.
+base_checkpoint = 'checkpoint.base.chk'
+delta_checkpoint = 'checkpoint.delta.chk'
 
 
-def read_file(infile):
-    """
-    Opens and reads the input file.
-    Returns the binary data from the file.
-    """
-    with open(infile, 'rb') as f:
-        return f.read()
-
-
-def split_file(raw_file):
-    """
-    Splits the input file into uint16 pieces.
-    """
-    output = []
-    for idx in range(0, len(raw_file), 2):
-        val = unpack('<H', raw_file[idx : idx + 2])
-        output += [val[0]]
-    return output
-
-
-def load_memory(to_split):
-    """
-    Loads the split values into memory.
-    Returns the full memory array.
-    """
-    memory = [0] * 32768
-    for idx in range(len(to_split)):
-        memory[idx] = to_split[idx]
-    return memory
-
-
-def get_value(value, registers):
-    """
-    Returns the value for value, or the value from a register if applicable.
-    """
-    if value < 32768:
-        return value
-    else:
-        return registers[value % 32768]
-
-
-def set_value(value, location, registers, memory):
-    """
-    Determines if location refers to a register or memory and sets it to value.
-    """
-    if location < 32768:
-        memory[location] = value
-    else:
-        registers[location % 32768] = value
-
-
-def load_value(location, memory, registers):
-    """
-    Returns the value from memory given by location. If the location points to a register, returns memory at that location.
-    """
-    if location < 32768:
-        return memory[location]
-    else:
-        return memory[registers[location % 32768]]
-
-
-def disassemble(infile, outfile):
+def disassemble(infile, outfile, words=None):
     """
     Writes the disassembly generated from input file to output file.
+    words are the input file's words, if they've already been read.
     """
-    init = split_file(read_file(infile))
+    init = split_file(read_file(infile)) if words is None else words
     addr = 0
     with open(outfile, 'w') as f:
         while addr != len(init):
@@ -93,13 +40,19 @@ def disassemble(infile, outfile):
             addr += op_len
 
 
-def run(memory, stack, registers, offset, debug_file):
+def run(memory, stack, registers, offset, debug_file, checkpoint_every=0, compress=False, jit=False, host=None,
+        profile=None, profile_file='profile.json', journal=None, breakpoints=()):
     """
     Handles VM execution with execution loop.
+    journal is a journal.Journal to record every instruction into, so the console can step back through them.
+    breakpoints are debugger commands to start with, like 'break 6027' or 'watch w 3952' (see debugger.py).
+    profile is a profiler.Profile to fill in. Its report is printed and exported to profile_file at the end.
+    host is a dict of intrinsics to run in place of guest routines, keyed by address (see intrinsics.py).
+    With jit set, hot blocks get compiled to Python functions (see blocks.py) instead of always being interpreted.
+    With checkpoint_every set, a full base checkpoint is written at the start and a delta against it every that many
+    instructions.
     """
-    debug = False
-    tamper = False
-    breakpoint = -1
+    tracer = None
 
     def serve_interrupt():
         """
@@ -107,12 +60,13 @@ def run(memory, stack, registers, offset, debug_file):
         Allows halting the program 'h', toggling debug logging on and off 'd', continuing execution 'c',
         tampering with the teleporter (for code 7) 't', checkpointing the current program state 'x',
         dumping the whole current memory to stdout 'm' or just registers and stack 's',
-        and setting a breakpoint 'b'.
+        printing the profile so far 'p', inspecting memory 'i', and setting, listing, enabling or deleting breakpoints and watchpoints 'b'.
+        With a journal, it can also step back a number of instructions 'u', or back to the last write to an address 'w'.
         """
-        if breakpoint:
-            print("Breakpoint hit at:", breakpoint)
+        nonlocal offset
         print("\n-----\nh: halt, m: dump memory, d: toggle debug, c: continue, t: toggle teleport tamper,\n"
-              "x: checkpoint current program state, s: dump reg/stack, b: set breakpoint at offset")
+              "x: checkpoint current program state, s: dump reg/stack, p: print profile, b: breakpoints,\n"
+              "u: step back N instructions, w: step back to the last write to an address, i: inspect memory")
         choice = sys.stdin.read(2).rstrip()
         if choice == 'h':
             return True
@@ -123,192 +77,144 @@ def run(memory, stack, registers, offset, debug_file):
             state = save_state(memory, stack, registers, offset)
             print("registers:", state['registers'], ",stack:", state['stack'])
         elif choice == 'd':
-            nonlocal debug
-            debug = not debug
-            print("debug:", debug)
+            nonlocal tracer
+            if tracer:
+                tracer.flush(registers, stack)
+                tracer = None
+            else:
+                tracer = Tracer(registers, stack, debug_file)
+            update_fusion()
+            print("debug:", bool(tracer))
         elif choice == 't':
-            nonlocal tamper
-            tamper = not tamper
+            tamper = decoded.intrinsics.get(6027) is not intrinsics.skip_teleporter_check
+            if tamper:
+                decoded.add_intrinsic(6027, intrinsics.skip_teleporter_check)
+            elif host and 6027 in host:
+                decoded.add_intrinsic(6027, host[6027])
+            else:
+                decoded.remove_intrinsic(6027)
             print("tamper:", tamper)
             registers[7] = 5
+        elif choice == 'p':
+            if profile:
+                profile.report(memory)
+            else:
+                print("not profiling.")
         elif choice == 'x':
-            state = save_state(memory, stack, registers, offset)
-            with open('checkpoint.json', 'w') as f:
-                print(json.dumps(state), file=f)
+            checkpoint.save('checkpoint.chk', memory, stack, registers, offset, compress=compress)
             print("current state checkpointed.")
-        if choice == 'b':
-            print("value? (current:", breakpoint, "):")
-            raw = sys.stdin.readlines(1)
-            value = int(''.join([x.rstrip() for x in raw]))
-            print("setting breakpoint at:", value)
+        elif choice in ('u', 'w'):
+            if journal:
+                if choice == 'u':
+                    print("instructions back? (up to", journal.available(), "):")
+                else:
+                    print("address? (over 32767 for a register):")
+                value = int(sys.stdin.readline())
+                steps = value if choice == 'u' else journal.steps_to_write(value)
+                back = journal.back(steps or 0, memory, stack, registers, decoded)
+                if back is None:
+                    print("nothing to go back to.")
+                else:
+                    offset = back
+                    print("back at offset:", offset, "registers:", registers)
+            else:
+                print("not journaling.")
+        elif choice == 'i':
+            import memtools
+            print(memtools.usage)
+            print(memtools.command(sys.stdin.readline(), memory))
+        elif choice == 'b':
+            print(usage)
+            print(debugger.command(sys.stdin.readline()))
         else:  # 'c' or any other char continues.
             pass
         print("\n-----")
         return False
 
-    halt = False
-    while True:
-        while not halt:
-            try:
-                halt, memory, stack, registers, offset = run_inner(memory, stack, registers, offset, debug, tamper, breakpoint)
-            # Catch the keyboard interrupt for ctrl + c
-            except KeyboardInterrupt:
-                halt = serve_interrupt()
-                break
-        if halt:
-            break
+    def update_fusion():
+        """
+        Fuses runs of instructions only while nothing needs to see every one of them.
+        """
+        fuse = not (tracer or journal or (profile and profile.mode != 'sample'))
+        if decoded.fuse != fuse:
+            decoded.fuse = fuse
+            decoded.reset()
 
+    interrupted = []
 
-def run_inner(memory, stack, registers, offset, debug, tamper, breakpoint):
-    """
-    Takes care of running the VM for on 'tic', and makes debug output if needed.
-    """
+    def on_interrupt(signum, frame):
+        """
+        ctrl+c only sets a flag, which gets checked between batches. If the VM is blocked waiting for input the
+        'in' instruction hasn't changed anything yet, so it's safe to break out of it right away.
+        """
+        interrupted.append(signum)
+        if frame is not None and frame.f_code is op_in.__code__:
+            raise Interrupted("interrupted")
+
+    base = None
+    until_checkpoint = checkpoint_every
+    if checkpoint_every:
+        base = array('H', memory)
+        checkpoint.save(base_checkpoint, memory, stack, registers, offset, compress=compress)
+
+    run_fast = run_batch
+    decoded = DecodeCache(memory)
+    if jit:
+        from blocks import BlockCache, run_tiered
+        run_fast = run_tiered
+        decoded = BlockCache(memory)
+    for address, function in (host or {}).items():
+        decoded.add_intrinsic(address, function)
+    if profile:
+        if profile.mode != 'sample':
+            run_fast = profile.run_batch
+        profile.start(memory)
+    if journal:
+        run_fast = journal.run_batch
+    update_fusion()
+    from debugger import Debugger, usage
+    debugger = Debugger(decoded)
+    for command in breakpoints:
+        print(debugger.command(command))
+    previous_handler = signal.signal(signal.SIGINT, on_interrupt)
     halt = False
-    op = memory[offset]
-    num_params = param_lens[op]
-    op_len = 1 + num_params
-    print_char = ''
-    params = memory[offset + 1 : offset + 1 + num_params]
-    start_offset = offset
-
-    if breakpoint == offset:
-        raise KeyboardInterrupt
-
-    if op == 0:  # "0": Halt execution
-        halt = True
-    elif op == 1:  # "1 a b": set register <a> to value of <b>
-        reg = params[0]
-        val_b = get_value(params[1], registers)
-        set_value(val_b, reg, registers, memory)
-        offset += op_len
-    elif op == 2:  # "2 a": push <a> onto stack.
-        val_a = get_value(memory[offset + 1], registers)
-        stack.append(val_a)
-        offset += op_len
-    elif op == 3:  # "3 a": pop from stack into <a>, empty is error, assuming <a> is a memory location
-        val = stack.pop()
-        loc = memory[offset + 1]
-        set_value(val, loc, registers, memory)
-        offset += op_len
-    elif op == 4:  # "4 a b c": set <a> = 1 if <b> == <c>, set <a> = 0 otherwise
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = 0
-        if val_b == val_c:
-            res = 1
-        loc = params[0]
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 5:  # "5 a b c": set <a> = 1 if <b> > <c>, set <a> = 0 otherwise
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = 0
-        if val_b > val_c:
-            res = 1
-        loc = params[0]
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 6:  # "6 a": jump to memory location <a>
-        new_offset = memory[offset + 1]
-        offset = new_offset
-    elif op == 7:  # "7 a b": jump to <b> if <a> != 0
-        val_a = get_value(params[0], registers)
-        new_offset = offset + op_len
-        if val_a != 0:
-            new_offset = get_value(params[1], registers)
-        if tamper and offset == 6027:
-            new_offset = 6030
-            registers[1] = 5
-            registers[7] = 25734
-            print("Teleport check skipped.")
-        offset = new_offset
-    elif op == 8:  # "8 a b": jump to <b> if <a> == 0
-        val_a = get_value(params[0], registers)
-        new_offset = offset + op_len
-        if val_a == 0:
-            new_offset = get_value(params[1], registers)
-        offset = new_offset
-    elif op == 9:  # "9 a b c": <a> = <b> + <c>, % 32768
-        loc = params[0]
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = (val_b + val_c) % 32768
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 10:  # "10 a b c": <a> = <b> * <c>, % 32768
-        loc = params[0]
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = (val_b * val_c) % 32768
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 11:  # "11 a b c": <a> = remainder <b> / <c>
-        loc = params[0]
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = val_b % val_c
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 12:  # "12 a b c": <a> = <b> and <c>
-        loc = params[0]
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = val_b & val_c
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 13:  # "13 a b c": <a> = <b> or <c>
-        loc = params[0]
-        val_b = get_value(params[1], registers)
-        val_c = get_value(params[2], registers)
-        res = val_b | val_c
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 14:  # "14 a b": <a> = not <b> (bitwise inverse)
-        loc = params[0]
-        val_b = get_value(params[1], registers)
-        res = 32767 - val_b
-        set_value(res, loc, registers, memory)
-        offset += op_len
-    elif op == 15:  # "15 a b": read memory address <b> and write it to <a>
-        dest = params[0]
-        val_b = load_value(params[1], memory, registers)
-        set_value(val_b, dest, registers, memory)
-        offset += op_len
-    elif op == 16:  # "16 a b": read memory address <b> and write to <a>
-        loc = params[0]
-        if loc > 32767:
-            loc = get_value(loc, registers)
-        val_b = get_value(params[1], registers)
-        set_value(val_b, loc, registers, memory)
-        offset += op_len
-    elif op == 17:  # "17 a": Write address of next instruction to stack and jump to memory location <a>
-        next_offset = offset + op_len
-        stack.append(next_offset)
-        offset = get_value(params[0], registers)
-    elif op == 18:  # "18": remove element from stack and jump to it (empty stack = halt)
-        next_offset = stack.pop()
-        offset = next_offset
-    elif op == 19:  # "19 a": writes the ascii code at <a> to terminal
-        value = get_value(memory[offset + 1], registers)
-        print(chr(value), end='')
-        print_char = chr(value)
-        offset += op_len
-    elif op == 20:  # "20 a": read ascii character from terminal into <a>. Probably strung together ops to read a whole line.
-        char = ord(sys.stdin.read(1))
-        loc = params[0]
-        set_value(char, loc, registers, memory)
-        offset += op_len
-    elif op == 21:  # "21": No op
-        offset += op_len
-    else:
-        halt = True
-
-    if debug:
-        with open(debug_file, 'a') as logfile:
-            nice_params = ' '.join([str(x) for x in params])
-            print(print_char, '|', "offset:", start_offset, "\nregs:", registers, "\nstack:", stack, file=logfile)
-            print("op:", op_table[op], nice_params, "\n", file=logfile)
-    return halt, memory, stack, registers, offset
+    try:
+        while not halt:
+            try:
+                if interrupted:
+                    interrupted.clear()
+                    halt = serve_interrupt()
+                elif tracer:
+                    if journal:
+                        handler, params, op = decoded[offset]
+                        found = journal.prepare(memory, stack, registers, offset, params, op, decoded)
+                        start_offset = offset
+                    halt, memory, stack, registers, offset = run_inner(memory, stack, registers, offset, tracer, -1, decoded)
+                    if journal:
+                        journal.commit(start_offset, found)
+                    until_checkpoint -= 1
+                else:
+                    count = min(batch_size, until_checkpoint) if checkpoint_every else batch_size
+                    offset, halt = run_fast(memory, stack, registers, offset, decoded, count)
+                    until_checkpoint -= count
+                if checkpoint_every and until_checkpoint <= 0:
+                    checkpoint.save(delta_checkpoint, memory, stack, registers, offset, base, base_checkpoint, compress)
+                    until_checkpoint = checkpoint_every
+            # ctrl+c while waiting on input comes through here.
+            except Interrupted:
+                interrupted.append(signal.SIGINT)
+            except Break as hit:
+                offset = hit.offset
+                print("\n-----\n" + str(hit))
+                interrupted.append(signal.SIGINT)
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+        if tracer:
+            tracer.flush(registers, stack)
+        if profile:
+            profile.stop()
+            profile.report(memory)
+            profile.export(profile_file, memory)
 
 
 def save_state(memory, stack, registers, offset):
@@ -316,72 +222,102 @@ def save_state(memory, stack, registers, offset):
     Dumps the machine state into JSON for reloading later.
     """
     output = {}
-    output['memory'] = memory
+    output['memory'] = list(memory)
     output['stack'] = stack
     output['registers'] = registers
     output['offset'] = offset
     return output
 
 
-def load_state(infile='checkpoint.json'):
-    with open(infile, 'r') as f:
-        data = json.load(f)
-    return data
+def load_state(infile='checkpoint.chk'):
+    """
+    Loads a checkpoint, binary or old JSON.
+    """
+    return checkpoint.load(infile)
 
 
 def print_state(state):
     """
     Takes a state dict and prints it nicely.
     """
+    from memtools import text
     print("offset:", state['offset'], "\n\nstack:", state['stack'], "\n\nregisters:", state['registers'], "\n\nmemory:")
-    s = ''
-    for c in state['memory']:
-        if c in [11, 12, 13, 14, 15]:
-            s += chr(c)
-        elif c >= 0x20:
-            s += chr(c)
-        else:
-            s += "\\" + hex(c)
-    print(s)
+    print(text(state['memory']))
 
 
 def parse_command_line():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', dest="input_file", help="Input (challenge).bin", metavar="INFILE", required=True)
-    parser.add_argument('-x', '--checkpoint', dest="checkpoint_file", help="Input checkpoint .json", metavar="CHECKPOINT", required=False)
-    parser.add_argument('-d', '--debug', dest="debug_file", help="Debug file to append", metavar="DEBUG", required=False)
+    parser.add_argument('-x', '--checkpoint', dest="checkpoint_file", help="Input checkpoint (binary or old .json)", metavar="CHECKPOINT", required=False)
+    parser.add_argument('-k', '--checkpoint-every', dest="checkpoint_every", help="Write a delta checkpoint every N instructions", metavar="N", type=int, default=0, required=False)
+    parser.add_argument('-z', '--compress', dest="compress", help="Compress written checkpoints", action='store_true')
+    parser.add_argument('-d', '--debug', dest="debug_file", help="Binary debug trace to append", metavar="DEBUG", required=False)
+    parser.add_argument('-i', '--intrinsics', dest="intrinsics", help="Run host intrinsics from a .json config or module ('intrinsics' for the built in ones)", metavar="SPEC", action='append', default=[])
+    parser.add_argument('-j', '--jit', dest="jit", help="Compile hot blocks to Python functions", action='store_true')
+    parser.add_argument('-p', '--profile', dest="profile", help="Profile hot spots by counting every instruction or by sampling, or guest functions with 'calls'", choices=['count', 'sample', 'calls'], required=False)
+    parser.add_argument('--profile-out', dest="profile_file", help="Where to export the profile as JSON", metavar="FILE", default='profile.json')
+    parser.add_argument('-t', '--time-travel', dest="time_travel", help="Journal execution so the ctrl+c console can step backwards", action='store_true')
+    parser.add_argument('-b', '--break', dest="breakpoints", help="Debugger command to start with, like 'break 6027 if r7 == 1' or 'watch rw 3952-3960'", metavar="COMMAND", action='append', default=[])
+    parser.add_argument('-s', '--script', dest="script_file", help="Run headless, reading commands from this file", metavar="SCRIPT", required=False)
+    parser.add_argument('--stop-at', dest="stop_at", help="With -s, stop after N commands or at a named '#@' input point and checkpoint there", metavar="POINT", required=False)
     parser.add_argument('-a', '--disassemble', dest="disassembly_file", help="Disassembly file to write", metavar="FILE", required=False)
     args = parser.parse_args()
+    if args.stop_at and args.script_file:
+        import headless
+        with open(args.script_file) as f:
+            try:
+                headless.ScriptedInput(f.readlines(), args.stop_at)
+            except ValueError as error:
+                parser.error("--stop-at: {}".format(error))
     return args
 
 
 if __name__ == "__main__":
     options = parse_command_line()
     input_file = options.input_file
-    checkpoint = options.checkpoint_file
+    checkpoint_file = options.checkpoint_file
     debug_file = options.debug_file
     disassembly_file = options.disassembly_file
 
-    file = read_file(input_file)
-    split_input = split_file(file)
-    memory = load_memory(split_input)
+    program = load_program(input_file)
+    memory = program
     registers = [0] * 8
     stack = []
     offset = 0
 
     if not debug_file:
-        # Default debug file saved in same dir VM is run from.
-        debug_file = "debug.txt"
+        # Default debug trace saved in same dir VM is run from.
+        debug_file = "debug.trace"
 
-    if checkpoint:
-        state = load_state(checkpoint)
-        memory = state['memory']
+    if checkpoint_file:
+        state = load_state(checkpoint_file)
+        memory = load_memory(state['memory'])
         stack = state['stack']
         registers = state['registers']
         offset = state['offset']
 
     if disassembly_file:
-        disassemble(input_file, disassembly_file)
+        # The words already loaded, rather than reading the binary a second time.
+        disassemble(input_file, disassembly_file, program[:os.path.getsize(input_file) // 2])
         print(input_file, "disassembled to:", disassembly_file)
+    elif options.script_file:
+        import headless
+        with open(options.script_file) as f:
+            lines = f.readlines()
+        stop_file = 'checkpoint.chk' if options.stop_at else None
+        offset, halt, reason = headless.replay(memory, stack, registers, offset, lines, options.stop_at, stop_file, options.compress)
+        print("\n-----\n" + reason, "at offset:", offset, "(checkpointed)" if stop_file and not halt else "")
     else:
-        run(memory, stack, registers, offset, debug_file)
+        host = {}
+        for spec in options.intrinsics:
+            host.update(intrinsics.load(spec))
+        profile = None
+        if options.profile:
+            from profiler import Profile, CallProfile
+            profile = CallProfile() if options.profile == 'calls' else Profile(options.profile)
+        time_travel = None
+        if options.time_travel:
+            from journal import Journal
+            time_travel = Journal()
+        run(memory, stack, registers, offset, debug_file, options.checkpoint_every, options.compress, options.jit, host,
+            profile, options.profile_file, time_travel, options.breakpoints)
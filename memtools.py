@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+Memory inspection: dumps of a range as text, hex or disassembly, searching for words or strings, and diffs between
+two memory images. Works on live memory from the ctrl+c console, or on checkpoints and binaries from the command line.
+Searches run over the raw bytes of memory with bytes.find, and diffs compare whole pages first with checkpoint's
+changed_pages, only going word by word inside the pages that differ.
+"""
+
+import sys
+import argparse
+import checkpoint
+from checkpoint import PAGE_WORDS, changed_pages, to_bytes
+from vm import load_program, op_table, param_lens
+
+# How each word shows up in a text dump: printable as itself, anything else escaped, same as print_state always has.
+glyphs = [chr(c) if c >= 0x20 or 11 <= c <= 15 else "\\" + hex(c) for c in range(65536)]
+modes = ['text', 'hex', 'asm']
+usage = "dump START[-END] [text|hex|asm] | find WORD [WORD ...] | find \"TEXT\" | diff CHECKPOINT"
+
+
+def parse_range(text, default_length=256):
+    """
+    Parses 'start-end' (inclusive) or just a start, into (start, end) with end exclusive.
+    """
+    start, _, end = text.partition('-')
+    start = int(start)
+    end = int(end) + 1 if end else start + default_length
+    return start, min(end, 32768)
+
+
+def text(memory, start=0, end=32768):
+    """
+    Returns the words from start to end as text.
+    """
+    return ''.join(map(glyphs.__getitem__, memory[start:end]))
+
+
+def hexdump(memory, start=0, end=32768, width=8):
+    """
+    Returns hexdump style lines: the address, width words in hex, and the printable ones as characters.
+    """
+    lines = []
+    for address in range(start, end, width):
+        words = memory[address : min(address + width, end)]
+        shown = ''.join(chr(c) if 0x20 <= c < 0x7f else '.' for c in words)
+        lines.append("{:5}: {:<{}} |{}|".format(address, ' '.join('{:04x}'.format(c) for c in words), 5 * width - 1, shown))
+    return '\n'.join(lines)
+
+
+def disassembly(memory, start=0, end=32768):
+    """
+    Returns a linear disassembly of the words from start to end, in the same format as main.disassemble.
+    An instruction whose operands would run past the end of memory is shown with what's there, marked truncated.
+    """
+    lines = []
+    address = start
+    while address < end:
+        op = memory[address]
+        length = 1 if op > 21 else 1 + param_lens[op]
+        words = memory[address : min(address + length, len(memory))]
+        data = [str(x) for x in words]
+        if len(words) < length:
+            data.append("(truncated)")
+        elif op == 19 and words[1] < 32768:
+            data[-1] = chr(words[1])
+        lines.append("offset: {} - {} {}".format(address, op_table.get(op, 'data'), ' '.join(data)))
+        address += length
+    return '\n'.join(lines)
+
+
+def dump(memory, start, end, mode='text'):
+    if mode == 'hex':
+        return hexdump(memory, start, end)
+    if mode == 'asm':
+        return disassembly(memory, start, end)
+    return text(memory, start, end)
+
+
+def find(memory, pattern):
+    """
+    Returns every address where the words in pattern appear in a row.
+    """
+    haystack = to_bytes(memory)
+    needle = to_bytes(pattern)
+    found = []
+    at = haystack.find(needle)
+    while at >= 0:
+        # Only matches on a word boundary count.
+        if at % 2 == 0:
+            found.append(at // 2)
+        at = haystack.find(needle, at + 1)
+    return found
+
+
+def find_string(memory, string):
+    """
+    Returns every address where string is stored a character per word, as (address, length prefixed), where length
+    prefixed says whether the word before it holds its length, the way the challenge stores its strings.
+    """
+    return [(address, address > 0 and memory[address - 1] == len(string))
+            for address in find(memory, [ord(c) for c in string])]
+
+
+def diff(memory, other):
+    """
+    Returns the ranges where two memory images differ, as (start, end) pairs with end exclusive.
+    """
+    ranges = []
+    for page in changed_pages(memory, other):
+        base = page * PAGE_WORDS
+        for address in range(base, base + PAGE_WORDS):
+            if memory[address] != other[address]:
+                if ranges and ranges[-1][1] == address:
+                    ranges[-1][1] = address + 1
+                else:
+                    ranges.append([address, address + 1])
+    return [tuple(changed) for changed in ranges]
+
+
+def describe_diff(memory, other, limit=64):
+    """
+    Returns a line per changed range, with the old and new words, showing at most limit ranges.
+    """
+    ranges = diff(memory, other)
+    lines = ["{} changed ranges, {} words".format(len(ranges), sum(end - start for start, end in ranges))]
+    for start, end in ranges[:limit]:
+        lines.append("{}-{}: {} -> {}".format(start, end - 1, list(other[start:end][:8]), list(memory[start:end][:8])))
+    return '\n'.join(lines)
+
+
+def load_memory_image(path):
+    """
+    Returns the memory from a checkpoint, or a raw binary if it isn't one.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if head == checkpoint.MAGIC or path.endswith('.json'):
+        return checkpoint.load(path)['memory']
+    return load_program(path)
+
+
+def command(line, memory):
+    """
+    Runs one console command against memory. Returns what to print.
+    """
+    words = line.split()
+    try:
+        if words[0] == 'dump':
+            start, end = parse_range(words[1])
+            return dump(memory, start, end, words[2] if len(words) > 2 else 'text')
+        if words[0] == 'find':
+            rest = line.split(None, 1)[1].strip()
+            if rest.startswith('"'):
+                return '\n'.join("{}{}".format(address, " (length prefixed)" if prefixed else '')
+                                 for address, prefixed in find_string(memory, rest.strip('"'))) or "not found."
+            return ' '.join(str(address) for address in find(memory, [int(x) for x in rest.split()])) or "not found."
+        if words[0] == 'diff':
+            return describe_diff(memory, load_memory_image(words[1]))
+    except (IndexError, ValueError, OSError) as error:
+        return "{}: {}\n{}".format(type(error).__name__, error, usage)
+    return usage
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Memory inspection over checkpoints and binaries.")
+    parser.add_argument('input_file', help="Checkpoint (binary or .json) or raw .bin to inspect", metavar="FILE")
+    parser.add_argument('-r', '--range', dest="range", help="Range to dump, START-END inclusive, or START for 256 words", metavar="RANGE", required=False)
+    parser.add_argument('-m', '--mode', dest="mode", help="How to dump the range", choices=modes, default='text')
+    parser.add_argument('-w', '--words', dest="words", help="Search for these words in a row", metavar="WORD", type=int, nargs='+', required=False)
+    parser.add_argument('-s', '--string', dest="string", help="Search for a string stored a character per word", metavar="TEXT", required=False)
+    parser.add_argument('-d', '--diff', dest="diff_file", help="List the ranges that changed from this earlier checkpoint or binary", metavar="FILE", required=False)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    memory = load_memory_image(options.input_file)
+    if options.range:
+        print(dump(memory, *parse_range(options.range), options.mode))
+    if options.words:
+        print(' '.join(str(address) for address in find(memory, options.words)) or "not found.")
+    if options.string:
+        for address, prefixed in find_string(memory, options.string):
+            print(address, "(length prefixed)" if prefixed else '')
+    if options.diff_file:
+        print(describe_diff(memory, load_memory_image(options.diff_file), limit=sys.maxsize))
+    if not (options.range or options.words or options.string or options.diff_file):
+        print(text(memory))
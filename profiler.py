@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""
+Hot spot profiling.
+Counting mode swaps in its own copy of the batch loop that bumps a per-opcode and a per-address counter for every
+instruction, in preallocated arrays. Sampling mode leaves the fast path untouched: a profiling timer interrupts
+execution every so often, and the handler looks up the interrupted execution loop's offset from its frame.
+Call graph mode follows 'call' and 'ret' with a shadow call stack, and charges instructions and time to guest
+functions, both inclusive and exclusive of what they call.
+"""
+
+from array import array
+import os
+import sys
+import json
+import time
+import signal
+from vm import HALT, Interrupted, Stop, op_table, param_lens
+
+# Execution loops a sample can find the current offset in.
+loops = {'run_batch', 'run_tiered', 'run_inner'}
+
+
+def describe(memory, address):
+    """
+    Disassembles the instruction currently at address.
+    """
+    op = memory[address]
+    if op > 21:
+        return "offset: {} - data {}".format(address, op)
+    params = list(memory[address + 1 : address + 1 + param_lens[op]])
+    data = [str(op)] + [str(x) for x in params]
+    if op == 19 and params[0] < 32768:
+        data[-1] = chr(params[0])
+    return "offset: {} - {} {}".format(address, op_table[op], ' '.join(data))
+
+
+class Profile:
+    """
+    Opcode and address counters, filled in either by counting every instruction or by sampling every interval seconds
+    of CPU time.
+    """
+    def __init__(self, mode='count', interval=0.0005):
+        self.mode = mode
+        self.interval = interval
+        self.ops = array('Q', bytes(8 * 65536))
+        self.addresses = array('Q', bytes(8 * 32768))
+        self.memory = None
+
+    def run_batch(self, memory, stack, registers, offset, decoded, count):
+        """
+        Same as vm.run_batch, but counting each instruction as it goes.
+        """
+        ops = self.ops
+        addresses = self.addresses
+        try:
+            for _ in range(count):
+                handler, params, op = decoded[offset]
+                ops[op] += 1
+                addresses[offset] += 1
+                next_offset = handler(memory, stack, registers, offset, params, decoded)
+                if next_offset == HALT:
+                    return offset, True
+                offset = next_offset
+        except Interrupted:
+            pass
+        except Stop as stop:
+            stop.offset = offset
+            raise
+        return offset, False
+
+    def start(self, memory):
+        """
+        Starts taking samples, if sampling.
+        """
+        self.memory = memory
+        if self.mode == 'sample':
+            signal.signal(signal.SIGPROF, self.on_sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.mode == 'sample':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def on_sample(self, signum, frame):
+        while frame is not None and frame.f_code.co_name not in loops:
+            frame = frame.f_back
+        if frame is None:
+            return
+        offset = frame.f_locals.get('offset')
+        if offset is not None and 0 <= offset < 32768:
+            self.addresses[offset] += 1
+            self.ops[self.memory[offset]] += 1
+
+    def hot_spots(self, top=None):
+        """
+        Returns (address, count) pairs, busiest first.
+        """
+        spots = sorted(((count, address) for address, count in enumerate(self.addresses) if count), reverse=True)
+        return [(address, count) for count, address in spots[:top]]
+
+    def op_counts(self):
+        """
+        Returns (op name, count) pairs, busiest first.
+        """
+        counts = [(count, op_table.get(op, 'data')) for op, count in enumerate(self.ops) if count]
+        merged = {}
+        for count, name in counts:
+            merged[name] = merged.get(name, 0) + count
+        return sorted(merged.items(), key=lambda item: -item[1])
+
+    def report(self, memory, top=20, outfile=sys.stdout):
+        """
+        Prints opcode counts and the top hot spots, each with the instruction there.
+        """
+        total = sum(self.ops) or 1
+        unit = 'instructions' if self.mode == 'count' else 'samples'
+        print("\n-----\nprofile: {} {}\nopcodes:".format(sum(self.ops), unit), file=outfile)
+        for name, count in self.op_counts():
+            print("  {:<6} {:>12} {:6.2f}%".format(name, count, 100.0 * count / total), file=outfile)
+        print("hot spots:", file=outfile)
+        for address, count in self.hot_spots(top):
+            print("  {:>12} {:6.2f}%  {}".format(count, 100.0 * count / total, describe(memory, address)), file=outfile)
+
+    def export(self, path, memory):
+        """
+        Writes the full profile as JSON.
+        """
+        output = {}
+        output['mode'] = self.mode
+        output['total'] = sum(self.ops)
+        output['ops'] = dict(self.op_counts())
+        output['addresses'] = [{'offset': address, 'count': count, 'instruction': describe(memory, address)}
+                               for address, count in self.hot_spots()]
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=1)
+
+
+def function_name(function):
+    return 'root' if function is None else 'function_{}'.format(function)
+
+
+class CallProfile:
+    """
+    Guest call graph profile. Every 'call' pushes a shadow frame and the 'ret' back to its return address pops it.
+    A 'ret' to an address further down the shadow stack unwinds to there, and one that matches no frame at all is
+    taken as a computed jump and ignored.
+    Per function it keeps [calls, inclusive instructions, exclusive instructions, inclusive seconds, exclusive seconds].
+    Recursion only counts towards inclusive cost once, for the outermost activation, while exclusive cost is summed
+    over all of them. Exclusive instructions are also kept per call stack, for flame graphs.
+    """
+    mode = 'calls'
+
+    def __init__(self):
+        self.executed = 0
+        self.stats = {}
+        self.folded = {}
+        self.active = {}
+        self.frames = []
+
+    def start(self, memory):
+        self.frames = [self.frame(None, None, (function_name(None),))]
+        self.active[None] = 1
+
+    def stop(self):
+        pass
+
+    def frame(self, function, return_address, path):
+        """
+        New shadow frame: function, return address, instructions and time at entry, children's instructions and time,
+        and the call stack as names.
+        """
+        return [function, return_address, self.executed, time.perf_counter(), 0, 0.0, path]
+
+    def enter(self, function, return_address):
+        path = self.frames[-1][6] + (function_name(function),)
+        self.frames.append(self.frame(function, return_address, path))
+        self.active[function] = self.active.get(function, 0) + 1
+
+    def leave(self, return_address):
+        for depth in range(len(self.frames) - 1, 0, -1):
+            if self.frames[depth][1] == return_address:
+                now = time.perf_counter()
+                while len(self.frames) > depth:
+                    self.close(self.frames.pop(), now, self.stats, self.folded, self.active)
+                return
+
+    def close(self, frame, now, stats, folded, active):
+        """
+        Charges a finished frame to its function and its caller.
+        """
+        function, return_address, count, began, child_count, child_time, path = frame
+        inclusive = self.executed - count
+        seconds = now - began
+        entry = stats.setdefault(function, [0, 0, 0, 0.0, 0.0])
+        entry[0] += 1
+        if active[function] == 1:
+            entry[1] += inclusive
+            entry[3] += seconds
+        active[function] -= 1
+        entry[2] += inclusive - child_count
+        entry[4] += seconds - child_time
+        folded[path] = folded.get(path, 0) + inclusive - child_count
+        if self.frames:
+            self.frames[-1][4] += inclusive
+            self.frames[-1][5] += seconds
+
+    def run_batch(self, memory, stack, registers, offset, decoded, count):
+        """
+        Same as vm.run_batch, but keeping the shadow call stack up to date.
+        """
+        try:
+            for _ in range(count):
+                handler, params, op = decoded[offset]
+                next_offset = handler(memory, stack, registers, offset, params, decoded)
+                self.executed += 1
+                if next_offset == HALT:
+                    return offset, True
+                if op == 17:
+                    self.enter(next_offset, offset + 2)
+                elif op == 18:
+                    self.leave(next_offset)
+                offset = next_offset
+        except Interrupted:
+            pass
+        except Stop as stop:
+            stop.offset = offset
+            raise
+        return offset, False
+
+    def snapshot(self):
+        """
+        Returns (stats, folded) as if every frame still running returned right now, without disturbing the live ones.
+        """
+        stats = {function: list(entry) for function, entry in self.stats.items()}
+        folded = dict(self.folded)
+        active = dict(self.active)
+        live = self.frames
+        self.frames = [list(frame) for frame in live]
+        now = time.perf_counter()
+        try:
+            while self.frames:
+                self.close(self.frames.pop(), now, stats, folded, active)
+        finally:
+            self.frames = live
+        return stats, folded
+
+    def report(self, memory, top=20, outfile=sys.stdout):
+        """
+        Prints the top functions by inclusive instructions.
+        """
+        stats, folded = self.snapshot()
+        total = self.executed or 1
+        print("\n-----\ncall profile: {} instructions\n{:<16} {:>9} {:>12} {:>7} {:>12} {:>7} {:>10} {:>10}".format(
+            self.executed, 'function', 'calls', 'incl', '%', 'excl', '%', 'incl s', 'excl s'), file=outfile)
+        ranked = sorted(stats.items(), key=lambda item: -item[1][1])[:top]
+        for function, (calls, inclusive, exclusive, inclusive_time, exclusive_time) in ranked:
+            print("{:<16} {:>9} {:>12} {:6.2f}% {:>12} {:6.2f}% {:>10.4f} {:>10.4f}".format(
+                function_name(function), calls, inclusive, 100.0 * inclusive / total, exclusive, 100.0 * exclusive / total,
+                inclusive_time, exclusive_time), file=outfile)
+
+    def export(self, path, memory):
+        """
+        Writes the per function table as JSON to path, and the exclusive instructions per call stack next to it, with a
+        .folded extension, in the collapsed stack format flame graph tools read.
+        """
+        stats, folded = self.snapshot()
+        output = {}
+        output['mode'] = self.mode
+        output['total'] = self.executed
+        output['functions'] = [{'function': function_name(function), 'calls': entry[0], 'inclusive': entry[1],
+                                'exclusive': entry[2], 'inclusive_seconds': entry[3], 'exclusive_seconds': entry[4]}
+                               for function, entry in sorted(stats.items(), key=lambda item: -item[1][1])]
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=1)
+        with open(os.path.splitext(path)[0] + '.folded', 'w') as f:
+            for stack_path, count in sorted(folded.items()):
+                if count:
+                    print(';'.join(stack_path), count, file=f)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Operand specialised handlers.
+The generic handlers work out every operand as they run, through get_value and set_value. Instead, each instruction
+can get a handler of its own made at decode time, for its op and for which of its operands are registers and which
+are literals, with the register numbers, literals and next offset already in hand. So the handler for 'add r0 r1 5'
+is just 'registers[a] = (registers[b] + c) % 32768' and a return of the next offset.
+A variant is one small function generated from source the first time its op and operand kinds turn up, and every
+instruction of that shape gets its own closure of it over its operands. Handlers keep the generic handlers' signature,
+and the decoded params stay as they are, so nothing else needs to know an instruction is specialised.
+"""
+
+import sys
+
+# What ops that write their first operand write there, over their other operands b and c.
+computes = {1: '{b}', 3: 'stack.pop()', 4: '1 if {b} == {c} else 0', 5: '1 if {b} > {c} else 0',
+            9: '({b} + {c}) % 32768', 10: '({b} * {c}) % 32768', 11: '{b} % {c}', 12: '{b} & {c}', 13: '{b} | {c}',
+            14: '32767 - {b}', 15: 'memory[{b}]'}
+# What the other ops run, over their operands a and b. Ones that don't return fall through to the next offset.
+statements = {2: 'stack.append({a})', 6: 'return {a}', 7: 'if {a} != 0:\n    return {b}',
+              8: 'if {a} == 0:\n    return {b}', 16: 'memory[{a}] = {b}\ndecoded.invalidate({a})',
+              17: 'stack.append(next_offset)\nreturn {a}', 19: '(decoded.stdout or sys.stdout).write({a})'}
+# Made so far, by (op, operand kinds).
+factories = {}
+
+
+def kinds_of(params):
+    """
+    Returns the kind of each operand, 'r' for a register and 'i' for a literal, and the register number or literal
+    for each, or None if any operand is neither.
+    """
+    kinds = ''
+    values = []
+    for value in params:
+        if value < 32768:
+            kinds += 'i'
+            values.append(value)
+        elif value < 32776:
+            kinds += 'r'
+            values.append(value - 32768)
+        else:
+            return None
+    return kinds, values
+
+
+def source(op, kinds):
+    """
+    Generates the source of a function making handlers for op with operands of these kinds.
+    """
+    reads = {name: 'registers[{}]'.format(name) if kind == 'r' else name for name, kind in zip('abc', kinds)}
+    if op in computes:
+        value = computes[op].format(**reads)
+        if kinds[0] == 'r':
+            body = 'registers[a] = ' + value
+        else:
+            body = 'memory[a] = {}\ndecoded.invalidate(a)'.format(value)
+    elif op == 16 and kinds[0] == 'r':
+        # Like set_value, an address past memory in the register names a register instead.
+        body = ('where = registers[a]\nif where < 32768:\n    memory[where] = {b}\n    decoded.invalidate(where)\n'
+                'else:\n    registers[where % 32768] = {b}').format(**reads)
+    elif op == 19 and kinds == 'r':
+        body = statements[op].format(a='chr(registers[a])')
+    else:
+        body = statements[op].format(**reads)
+    if op not in (6, 17):
+        body += '\nreturn next_offset'
+    name = 'op{}_{}'.format(op, kinds)
+    lines = ['def make(a, b, c, next_offset):', '    def {}(memory, stack, registers, offset, params, decoded):'.format(name)]
+    lines += ['        ' + line for line in body.split('\n')]
+    lines.append('    return ' + name)
+    return '\n'.join(lines) + '\n'
+
+
+def handler_for(op, params, offset):
+    """
+    Returns a handler for the instruction at offset with its operands baked in, or None if it's left to the generic
+    handler: halt, ret, in and noop, jmp through a register, and anything with an operand past the registers.
+    """
+    if op not in computes and op not in statements:
+        return None
+    found = kinds_of(params)
+    if found is None:
+        return None
+    kinds, values = found
+    if op == 6 and kinds != 'i':
+        # The generic jmp takes its operand as the address even if it names a register.
+        return None
+    if op == 19 and kinds == 'i':
+        values[0] = chr(values[0])
+    make = factories.get((op, kinds))
+    if make is None:
+        namespace = {'sys': sys}
+        exec(compile(source(op, kinds), '<op {} {}>'.format(op, kinds), 'exec'), namespace)
+        make = factories[(op, kinds)] = namespace['make']
+    values += [None] * (3 - len(values))
+    return make(*values, offset + 1 + len(params))
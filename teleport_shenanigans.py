@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import time
+import argparse
 import resource
-
-sys.setrecursionlimit(1000000000)
-resource.setrlimit(resource.RLIMIT_STACK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+import multiprocessing
 
 
 """
@@ -120,14 +121,140 @@ def shenanigans4(a, b, c):
             stack.append(b1 - 1)
     return stack.pop()
 
+def dp_row(prev, c, length=32768):
+    """
+    Computes f(a, b) for b up to length from row a - 1, using f(a, 0) = f(a - 1, c) and f(a, b) = f(a - 1, f(a, b - 1)).
+    Each entry depends on the one before, so this one has to go one at a time.
+    prev is either the whole previous row, or (start, step) when that row is affine.
+    """
+    row = [0] * length
+    if isinstance(prev, tuple):
+        start, step = prev
+        x = (start + step * c) % 32768
+        row[0] = x
+        for b in range(1, length):
+            x = (start + step * x) & 32767
+            row[b] = x
+    else:
+        x = prev[c]
+        row[0] = x
+        for b in range(1, length):
+            x = prev[x]
+            row[b] = x
+    return row
+
+
+def solve(a, b, c):
+    """
+    Same function as shenanigans3, but worked out bottom up one row of a at a time, with no recursion or cache.
+    Only the previous row is kept around, so memory stays at a couple of 32768 entry rows.
+    Rows 0 to 2 are affine in b, f(a, b) = start + step * b, so they're worked out in closed form instead of looping.
+    """
+    prev = (1, 1)  # Row 0 is f(0, b) = b + 1.
+    for row_a in range(1, a + 1):
+        if isinstance(prev, tuple) and prev[1] == 1:
+            # The row below just adds start, so this one goes up by that much each time from f(a, 0) = f(a - 1, c).
+            start, step = prev
+            prev = ((start + c) % 32768, start)
+        else:
+            prev = dp_row(prev, c, b + 1 if row_a == a else 32768)
+    if isinstance(prev, tuple):
+        return (prev[0] + prev[1] * b) % 32768
+    return prev[b]
+
+
+def sweep(candidates, target=6, solver=solve):
+    """
+    Tries each reg7 candidate against the confirmation check, f(4, 1, r7) == target.
+    Yields (candidate, result, seconds taken) for each one.
+    """
+    global cache
+    for x in candidates:
+        cache = {}
+        start = time.perf_counter()
+        rslt = solver(4, 1, x)
+        yield x, rslt, time.perf_counter() - start
+
+
+def recursive(a, b, c):
+    """
+    shenanigans3, with the recursion and stack limits raised first, since it goes tens of thousands of calls deep.
+    Only done here, so importing this module leaves the process's limits alone.
+    """
+    sys.setrecursionlimit(1000000000)
+    resource.setrlimit(resource.RLIMIT_STACK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+    return shenanigans3(a, b, c)
+
+
+solvers = {'dp': solve, 'recursive': recursive}
+
+
+def search_chunk(args):
+    """
+    Worker side of parallel_search: runs a slice of candidates, stopping early if one hits the target.
+    Returns (hit or 0, candidates tried, seconds spent).
+    """
+    candidates, target, solver_name = args
+    tried = 0
+    spent = 0.0
+    for x, rslt, seconds in sweep(candidates, target, solvers[solver_name]):
+        tried += 1
+        spent += seconds
+        if rslt == target:
+            return x, tried, spent
+    return 0, tried, spent
+
+
+def parallel_search(candidates, target=6, solver_name='dp', workers=None, chunk_size=64, report_every=5.0):
+    """
+    Splits the candidates into chunks across a process pool and streams back the results as they finish.
+    Every worker is cancelled as soon as any of them finds the target, and progress with throughput gets printed
+    every report_every seconds.
+    Returns the candidate that hit, or 0.
+    """
+    candidates = list(candidates)
+    chunks = [(candidates[idx : idx + chunk_size], target, solver_name) for idx in range(0, len(candidates), chunk_size)]
+    start = time.perf_counter()
+    last_report = start
+    done = 0
+    magic = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        for hit, tried, spent in pool.imap_unordered(search_chunk, chunks):
+            done += tried
+            now = time.perf_counter()
+            if hit:
+                magic = hit
+                break
+            if now - last_report >= report_every:
+                last_report = now
+                print("checked: {}/{}, {:.1f} candidates/s".format(done, len(candidates), done / (now - start)))
+    finally:
+        pool.terminate()
+        pool.join()
+    elapsed = time.perf_counter() - start
+    print("checked: {} in {:.1f}s, {:.1f} candidates/s".format(done, elapsed, done / elapsed if elapsed else 0))
+    return magic
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--solver', dest="solver", help="Solver to use", choices=sorted(solvers), default='dp')
+    parser.add_argument('-j', '--jobs', dest="jobs", help="Worker processes to search with, 1 searches in this process", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    return args
+
+
 if __name__ == "__main__":
+    options = parse_command_line()
     target = 6
     magic = 0
-    for x in range(32768, 0, -1):  # Reverse iterating seems to be faster.
-        cache = {}
-        rslt = shenanigans3(4, 1, x)
-        print("input:", x, "result:", rslt)
-        if rslt == target:
-            magic = x
-            break
+    if options.jobs > 1:
+        magic = parallel_search(range(32768, 0, -1), target, options.solver, options.jobs)
+    else:
+        for x, rslt, seconds in sweep(range(32768, 0, -1), target, solvers[options.solver]):  # Reverse iterating seems to be faster.
+            print("input:", x, "result:", rslt, "time: {:.4f}s".format(seconds))
+            if rslt == target:
+                magic = x
+                break
     print("magic:", magic)
@@ -0,0 +1,23 @@
+import asyncio
+import bench
+import control
+from vm import load_memory
+
+# mod by r1, which is still 0.
+faulting = bench.assemble([('set', 'r0', 5), ('mod', 'r0', 'r0', 'r1'), ('halt',)])
+printing = bench.assemble([('out', 111), ('out', 107), ('halt',)])
+
+
+def test_guest_fault_halts_only_its_own_session(tmp_path):
+    paths = [str(tmp_path / 'a.sock'), str(tmp_path / 'b.sock')]
+
+    async def start():
+        sessions = [control.Session(load_memory(words), [], [0] * 8, 0) for words in (faulting, printing)]
+        await asyncio.wait_for(control.serve_all(sessions, paths), 5)
+        return sessions
+    bad, good = asyncio.run(start())
+    assert bad.halted and good.halted
+    assert [event['event'] for event in bad.backlog] == ['error', 'halt']
+    assert bad.backlog[0]['text'].startswith('ZeroDivisionError')
+    assert ''.join(event.get('text', '') for event in good.backlog if event['event'] == 'output') == 'ok'
+    assert good.backlog[-1]['event'] == 'halt'
@@ -0,0 +1,28 @@
+import bench
+from explore import Explorer
+from vm import load_memory
+
+# Prompts, then reads a line: one starting with 'l' sends it into a loop that never reads again, anything else prompts
+# again.
+game = bench.assemble([
+    'top',
+    ('out', 62), ('out', 10),
+    ('in', 'r0'),
+    ('eq', 'r1', 'r0', 108),
+    ('jt', 'r1', 'spin'),
+    'rest',
+    ('eq', 'r1', 'r0', 10),
+    ('jt', 'r1', 'top'),
+    ('in', 'r0'),
+    ('jmp', 'rest'),
+    'spin',
+    ('jmp', 'spin'),
+])
+
+
+def test_command_that_loops_is_a_dead_end():
+    explorer = Explorer(load_memory(game), [], [0] * 8, 0, ['look', 'go'], max_depth=3, budget=10000)
+    explorer.run()
+    # The start, and 'go' once, after which 'go' comes back to the same state. Every 'look' runs out of budget.
+    assert len(explorer.seen) == 2
+    assert explorer.runs == 5
@@ -0,0 +1,23 @@
+import io
+import pytest
+from headless import BufferedOutput
+
+
+def test_kept_output_has_everything():
+    output = BufferedOutput(line_buffered=False, keep=True)
+    output.write('one\n')
+    output.flush()
+    output.write('two')
+    assert output.getvalue() == 'one\ntwo'
+    assert output.pending() == 'two'
+
+
+def test_output_not_kept_only_has_whats_pending():
+    target = io.StringIO()
+    output = BufferedOutput(target)
+    output.write('one\n')
+    output.write('two')
+    assert target.getvalue() == 'one\n'
+    assert output.pending() == 'two'
+    with pytest.raises(ValueError):
+        output.getvalue()
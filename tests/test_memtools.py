@@ -0,0 +1,7 @@
+from vm import load_memory
+from memtools import disassembly
+
+
+def test_disassembly_stops_at_the_end_of_memory():
+    memory = load_memory([0] * 32767 + [9])
+    assert disassembly(memory, 32767) == "offset: 32767 - add 9 (truncated)"
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Binary execution trace.
+Each executed instruction is one fixed-size record: offset, opcode, the register it changed (0xff for none),
+its three raw operands, the register's new value and the stack depth afterwards. If an instruction changes more
+than one register, the extra changes follow as records with opcode 0xff.
+Records are packed into a preallocated buffer that is written out in chunks. Each chunk starts with the registers
+and stack as they were before its first record, which is what lets the decoder rebuild the full text log.
+"""
+
+import argparse
+import os
+import struct
+import sys
+from vm import op_table, param_lens
+
+CHUNK_MAGIC = b'SYNT'
+CHUNK_HEADER = struct.Struct('<4sII8H')  # magic, record count, stack length, registers
+RECORD = struct.Struct('<HBBHHHHI')
+NO_REGISTER = 0xff
+EXTRA_REGISTER = 0xff
+
+
+
+class Tracer:
+    """
+    Records instructions into a ring of capacity records.
+    With a path, every full ring is appended to that file, which gets rotated to path + '.1' once it passes max_bytes.
+    Without one the previous ring is kept in memory, so the last capacity to 2 * capacity records are always around.
+    """
+    def __init__(self, registers, stack, path=None, capacity=65536, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.count = 0
+        self.previous = b''
+        self.start_chunk(registers, stack)
+
+    def start_chunk(self, registers, stack):
+        """
+        Snapshots the state the next chunk of records starts from.
+        """
+        self.count = 0
+        self.header_registers = list(registers)
+        self.header_stack = list(stack)
+
+    def chunk(self):
+        """
+        Returns the records so far as one chunk, header included.
+        """
+        header = CHUNK_HEADER.pack(CHUNK_MAGIC, self.count, len(self.header_stack), *self.header_registers)
+        stack = struct.pack('<{}H'.format(len(self.header_stack)), *self.header_stack)
+        return header + stack + bytes(self.buffer[:self.count * RECORD.size])
+
+    def record(self, offset, op, params, before, registers, stack):
+        """
+        Adds the instruction that just ran, given the registers from before it ran.
+        """
+        a, b, c = (tuple(params) + (0, 0, 0))[:3]
+        changed = [idx for idx in range(8) if before[idx] != registers[idx]] if before != registers else []
+        reg = changed[0] if changed else NO_REGISTER
+        self.append(offset, op if op <= 21 else 0xfe, reg, a, b, c, registers[reg] if changed else 0, len(stack))
+        for idx in changed[1:]:
+            self.append(offset, EXTRA_REGISTER, idx, 0, 0, 0, registers[idx], len(stack))
+        if self.count == self.capacity:
+            self.flush(registers, stack)
+
+    def append(self, *fields):
+        RECORD.pack_into(self.buffer, self.count * RECORD.size, *fields)
+        self.count += 1
+
+    def flush(self, registers, stack):
+        """
+        Writes out the records so far, and starts a new chunk from the current state.
+        """
+        if self.path:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'ab') as f:
+                f.write(self.chunk())
+        else:
+            self.previous = self.chunk()
+        self.start_chunk(registers, stack)
+
+    def dump(self, outfile):
+        """
+        Writes whatever is still held in memory to outfile, oldest first.
+        """
+        with open(outfile, 'wb') as f:
+            f.write(self.previous + self.chunk())
+
+
+def read_chunks(data):
+    """
+    Yields (registers, stack, records) for each chunk in a trace.
+    """
+    pos = 0
+    while pos < len(data):
+        magic, count, stack_len, *registers = CHUNK_HEADER.unpack_from(data, pos)
+        if magic != CHUNK_MAGIC:
+            raise ValueError("Not a trace chunk at byte {}".format(pos))
+        pos += CHUNK_HEADER.size
+        stack = list(struct.unpack_from('<{}H'.format(stack_len), data, pos))
+        pos += 2 * stack_len
+        yield registers, stack, RECORD.iter_unpack(data[pos : pos + count * RECORD.size])
+        pos += count * RECORD.size
+
+
+def render(data, outfile):
+    """
+    Renders a binary trace in the same text format the per-instruction debug log used to have.
+    Registers are rebuilt from the recorded deltas and the stack by replaying pushes and pops on top of each chunk's
+    starting state.
+    """
+    pending = None
+    for registers, stack, records in read_chunks(data):
+        for offset, op, reg, a, b, c, value, depth in records:
+            if op == EXTRA_REGISTER:
+                registers[reg] = value
+                continue
+            if pending:
+                print(*pending[0], registers, "\nstack:", pending[1], file=outfile)
+                print(*pending[2], file=outfile)
+            params = [a, b, c][:param_lens[op]] if op <= 21 else []
+            resolved = [x if x < 32768 else registers[x % 32768] for x in params]
+            print_char = ''
+            if op == 19:
+                print_char = chr(resolved[0])
+            elif op == 2:
+                stack.append(resolved[0])
+            elif op == 17:
+                stack.append(offset + 2)
+            elif op in (3, 18) and stack:
+                stack.pop()
+            if reg != NO_REGISTER:
+                registers[reg] = value
+            del stack[depth:]
+            # The registers can still change with extra records, so the lines are written once the next one starts.
+            pending = ((print_char, '|', "offset:", offset, "\nregs:"), list(stack),
+                       ("op:", op_table.get(op, 'data'), ' '.join([str(x) for x in params]), "\n"))
+    if pending:
+        print(*pending[0], registers, "\nstack:", pending[1], file=outfile)
+        print(*pending[2], file=outfile)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Render a binary VM trace as text.")
+    parser.add_argument('-i', '--input', dest="trace_file", help="Binary trace file", metavar="TRACE", required=True)
+    parser.add_argument('-o', '--output', dest="output_file", help="Text file to write, stdout if not given", metavar="FILE", required=False)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    options = parse_command_line()
+    with open(options.trace_file, 'rb') as f:
+        trace = f.read()
+    if options.output_file:
+        with open(options.output_file, 'w') as f:
+            render(trace, f)
+    else:
+        render(trace, sys.stdout)
@@ -1,5 +1,10 @@
 #!/usr/bin/env python
 
+import time
+import random
+import argparse
+from collections import deque
+
 room_grid =\
     [
         ['*', '8', '-', '1'],
@@ -16,54 +21,57 @@ dirs = {(1, 0): 'north', (-1, 0): 'south', (0, 1): 'west', (0, -1): 'east'}
 total = 30
 
 
-def find_equation(max_steps, position):
+def find_equation(max_steps, position, cells=rooms, goal=(0, 3), target=total):
     """
     Finds the equation by calling a recursive function.
     Gets things set up, by putting the value of the starting room in, and initializing the step list.
+    cells is the vault by (x, y), the real one unless another is given.
     """
-    equation = [(position, rooms[position])]
-    return find_equation_inner(max_steps, position, [], equation)
+    equation = [(position, cells[position])]
+    return find_equation_inner(max_steps, position, [], equation, cells, position, goal, target)
 
 
-def find_equation_inner(max_steps, position, steps, equation):
+def find_equation_inner(max_steps, position, steps, equation, cells=rooms, start=(3, 0), goal=(0, 3), target=total):
     """
     Recursive function to build up the equation.
-    Returns the cardinal directions as a list.
+    Returns the cardinal directions as a list, empty or None if there's no route.
     """
-    if position == (0, 3):
-        if check_result(equation):
+    if position == goal:
+        # The Manhattan distance between start and goal is the fewest steps possible.
+        if check_result(equation, target, abs(start[0] - goal[0]) + abs(start[1] - goal[1])):
             return steps
         else:
             return []
     elif max_steps == 0:
         return []
     else:
-        next_rooms = adjacent_rooms(position)
-        if (3, 0) in next_rooms:  # We don't want to go back to the start.
-            del next_rooms[(3, 0)]
+        next_rooms = adjacent_rooms(position, cells)
+        if start in next_rooms:  # We don't want to go back to the start.
+            del next_rooms[start]
         for k, v in next_rooms.items():
             direction = tuple([a - b for a, b in zip(position, k)])
-            res = find_equation_inner(max_steps - 1, k, steps + [dirs[direction]], equation + [(k, v)])
+            res = find_equation_inner(max_steps - 1, k, steps + [dirs[direction]], equation + [(k, v)], cells, start,
+                                      goal, target)
             if res:
                 return res
 
 
-def check_result(equation):
+def check_result(equation, target=total, shortest=6):
     """
     Runs the equation to see if algo has arrived at a solution.
     """
-    if len(equation) <= 6:  # 6 is the Manhattan distance between (3, 0) and (0, 3), and minimum possible.
+    if len(equation) <= shortest:  # 6 is the Manhattan distance between (3, 0) and (0, 3), and minimum possible.
         return False
     result = int(equation[0][1])
     for x in range(1, len(equation) - 1, 2):
         op = equation[x][1]
         result = ops[op](result, int(equation[x + 1][1]))
-    if result == 30:
+    if result == target:
         return True
     return False
 
 
-def adjacent_rooms(position):
+def adjacent_rooms(position, cells=rooms):
     """
     Takes the current position and returns the adjacent rooms in a plus (if applicable) around the room.
     """
@@ -71,14 +79,110 @@ def adjacent_rooms(position):
     result = {}
     for a, b in [(x + i, y + j) for i in [-1, 0, 1] for j in [-1, 0, 1]
                  if (i != 0 or j != 0) and not (i != 0 and j != 0)]:
-        if (a, b) in rooms:
-            result[(a, b)] = rooms[(a, b)]
+        if (a, b) in cells:
+            result[(a, b)] = cells[(a, b)]
     return result
 
 
+def solve(grid, target, start, goal, max_steps=None):
+    """
+    Breadth first search for the shortest route from start to goal that leaves the orb weighing target.
+    Works on any grid of numbers and operators. The state is just (position, value, pending operator), and each one
+    is only ever visited once, so routes aren't copied around or re-evaluated.
+    As in the vault, walking back into the start room isn't allowed and the goal room takes the orb either way.
+    Returns the directions (None if there's no route) and stats with nodes expanded and seconds elapsed.
+    """
+    began = time.perf_counter()
+    cells = {(a, b): grid[a][b] for a in range(len(grid)) for b in range(len(grid[a]))}
+    # Where each room leads, worked out once, minus the start room.
+    exits = {(x, y): [((x - i, y - j), cells[(x - i, y - j)], direction) for (i, j), direction in dirs.items()
+                      if (x - i, y - j) in cells and (x - i, y - j) != start] for x, y in cells}
+    first = (start, int(cells[start]), None)
+    parents = {first: None}
+    queue = deque([(first, 0)])
+    expanded = 0
+    route = None
+    while queue and route is None:
+        state, depth = queue.popleft()
+        expanded += 1
+        if max_steps is not None and depth >= max_steps:
+            continue
+        position, value, pending = state
+        for position, room, direction in exits[position]:
+            if room in ops:
+                after = (position, value, room)
+            elif pending is None:
+                continue
+            else:
+                after = (position, ops[pending](value, int(room)), None)
+            if after in parents:
+                continue
+            parents[after] = (state, direction)
+            if position == goal:
+                if after[1] == target:
+                    route = after
+                    break
+                continue
+            queue.append((after, depth + 1))
+    directions = None
+    if route is not None:
+        directions = []
+        while parents[route] is not None:
+            route, direction = parents[route]
+            directions.append(direction)
+        directions.reverse()
+    return directions, {'expanded': expanded, 'elapsed': time.perf_counter() - began}
+
+
+def generate_grid(size, seed=None, numbers=range(1, 20)):
+    """
+    Makes a size x size vault laid out like the real one: numbers and operators alternating in a checkerboard, with
+    numbers in the bottom left start and the top right goal corners.
+    """
+    rng = random.Random(seed)
+    parity = (size - 1) % 2
+    return [[str(rng.choice(numbers)) if (a + b) % 2 == parity else rng.choice(sorted(ops)) for b in range(size)]
+            for a in range(size)]
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dfs', dest="dfs", help="Use the original depth first search", action='store_true')
+    parser.add_argument('--compare', dest="compare", help="Also time both searches on a generated SIZE x SIZE grid", metavar="SIZE", type=int, required=False)
+    parser.add_argument('--dfs-steps', dest="dfs_steps", help="Most steps the depth first search tries", type=int, default=12)
+    parser.add_argument('--seed', dest="seed", help="Seed for the generated grid", type=int, default=0)
+    parser.add_argument('--target', dest="target", help="Target for the generated grid", type=int, default=total)
+    args = parser.parse_args()
+    return args
+
+
 if __name__ == "__main__":
-    # I chose 12 because it was the lowest number to produce useful output.
-    result = find_equation(12, (3, 0))
-    print(result)
-    for x in result:
-        print(x)
+    options = parse_command_line()
+    if options.dfs:
+        # I chose 12 because it was the lowest number to produce useful output.
+        began = time.perf_counter()
+        result = find_equation(options.dfs_steps, (3, 0))
+        print("dfs took {:.4f}s".format(time.perf_counter() - began))
+    else:
+        result, stats = solve(room_grid, total, (3, 0), (0, 3))
+        print("bfs expanded {} nodes in {:.4f}s".format(stats['expanded'], stats['elapsed']))
+    if result:
+        print(result)
+        for x in result:
+            print(x)
+    else:
+        print("no route to the vault door leaves the orb at {}".format(total))
+    if options.compare:
+        size = options.compare
+        grid = generate_grid(size, options.seed)
+        cells = {(a, b): grid[a][b] for a in range(size) for b in range(size)}
+        start, goal = (size - 1, 0), (0, size - 1)
+        route, stats = solve(grid, options.target, start, goal)
+        print("{0}x{0} grid, target {1}: bfs {2}, expanded {3} nodes in {4:.4f}s".format(
+            size, options.target, "{} steps".format(len(route)) if route else "no route", stats['expanded'],
+            stats['elapsed']))
+        began = time.perf_counter()
+        route = find_equation(options.dfs_steps, start, cells, goal, options.target)
+        print("{0}x{0} grid, target {1}: dfs {2} within {3} steps, in {4:.4f}s".format(
+            size, options.target, "{} steps".format(len(route)) if route else "no route", options.dfs_steps,
+            time.perf_counter() - began))
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+
+"""
+The VM itself: loading binaries into memory, the opcode handlers, the decode cache and the execution loops.
+main.py is the command line and ctrl+c console on top of it, and everything else that runs or inspects the VM imports
+from here.
+"""
+
+from array import array
+import sys
+from specialized import handler_for
+
+op_table = {0: 'halt', 1: 'set', 2: 'push', 3: 'pop', 4: 'eq', 5: 'gt',6 : 'jmp', 7: 'jt', 8: 'jf', 9: 'add', 10: 'mult', 11: 'mod', 12: 'and', 13: 'or', 14: 'not', 15: 'rmem', 16: 'wmem', 17: 'call', 18: 'ret', 19: 'out', 20: 'in', 21: 'noop'}
+param_lens = [0, 2, 1, 1, 3, 3, 1, 2, 2, 3, 3, 3, 3, 3, 2, 2, 2, 1, 0, 1, 1, 0]
+# How many instructions the fast path runs between checks for ctrl+c.
+batch_size = 100000
+
+
+def read_file(infile):
+    """
+    Opens and reads the input file.
+    Returns the binary data from the file.
+    """
+    with open(infile, 'rb') as f:
+        return f.read()
+
+
+def split_file(raw_file):
+    """
+    Splits the input file into uint16 pieces.
+    Returns them as a compact array of little-endian words, converted in one go.
+    """
+    output = array('H')
+    output.frombytes(raw_file[:len(raw_file) - len(raw_file) % 2])
+    if sys.byteorder == 'big':
+        output.byteswap()
+    return output
+
+
+def load_memory(to_split):
+    """
+    Loads the split values into memory.
+    Returns the full memory array.
+    """
+    memory = array('H', bytes(2 * 32768))
+    memory[:len(to_split)] = array('H', to_split)
+    return memory
+
+
+def load_program(infile):
+    """
+    Reads the input file straight into a zeroed memory array, without building any intermediate words.
+    Returns the full memory array.
+    """
+    memory = array('H', bytes(2 * 32768))
+    with open(infile, 'rb') as f:
+        f.readinto(memory)
+    if sys.byteorder == 'big':
+        memory.byteswap()
+    return memory
+
+
+def get_value(value, registers):
+    """
+    Returns the value for value, or the value from a register if applicable.
+    """
+    if value < 32768:
+        return value
+    else:
+        return registers[value % 32768]
+
+
+def set_value(value, location, registers, memory, decoded=None):
+    """
+    Determines if location refers to a register or memory and sets it to value.
+    Memory writes also invalidate any decoded instruction at that location, if a decode cache is given.
+    """
+    if location < 32768:
+        memory[location] = value
+        if decoded is not None:
+            decoded.invalidate(location)
+    else:
+        registers[location % 32768] = value
+
+
+def load_value(location, memory, registers):
+    """
+    Returns the value from memory given by location. If the location points to a register, returns memory at that location.
+    """
+    if location < 32768:
+        return memory[location]
+    else:
+        return memory[registers[location % 32768]]
+
+
+HALT = -1
+# Op given to fused runs of instructions, past anything a word of memory can hold.
+FUSED = 65536
+
+
+class Stop(Exception):
+    """
+    Raised to stop the VM before the current instruction has changed anything, like scripted input running out.
+    Execution loops fill in offset with the instruction to resume from.
+    """
+    offset = None
+
+
+class Interrupted(Stop):
+    """
+    Raised by main.run's ctrl+c handler to break out of an 'in' blocked waiting for input, before it has read anything.
+    """
+
+
+class Break(Stop):
+    """
+    Raised by the debugger when a breakpoint or watchpoint is hit, before the instruction it's on runs.
+    """
+
+
+# Opcode handlers. Each one takes the already decoded params and returns the offset of the next instruction,
+# or HALT. Anything that can write to memory goes through set_value with the decode cache so stale code gets dropped.
+def op_halt(memory, stack, registers, offset, params, decoded):
+    """
+    "0": Halt execution
+    """
+    return HALT
+
+
+def op_set(memory, stack, registers, offset, params, decoded):
+    """
+    "1 a b": set register <a> to value of <b>
+    """
+    set_value(get_value(params[1], registers), params[0], registers, memory, decoded)
+    return offset + 3
+
+
+def op_push(memory, stack, registers, offset, params, decoded):
+    """
+    "2 a": push <a> onto stack.
+    """
+    stack.append(get_value(params[0], registers))
+    return offset + 2
+
+
+def op_pop(memory, stack, registers, offset, params, decoded):
+    """
+    "3 a": pop from stack into <a>, empty is error, assuming <a> is a memory location
+    """
+    set_value(stack.pop(), params[0], registers, memory, decoded)
+    return offset + 2
+
+
+def op_eq(memory, stack, registers, offset, params, decoded):
+    """
+    "4 a b c": set <a> = 1 if <b> == <c>, set <a> = 0 otherwise
+    """
+    res = 1 if get_value(params[1], registers) == get_value(params[2], registers) else 0
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_gt(memory, stack, registers, offset, params, decoded):
+    """
+    "5 a b c": set <a> = 1 if <b> > <c>, set <a> = 0 otherwise
+    """
+    res = 1 if get_value(params[1], registers) > get_value(params[2], registers) else 0
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_jmp(memory, stack, registers, offset, params, decoded):
+    """
+    "6 a": jump to memory location <a>
+    """
+    return params[0]
+
+
+def op_jt(memory, stack, registers, offset, params, decoded):
+    """
+    "7 a b": jump to <b> if <a> != 0
+    """
+    if get_value(params[0], registers) != 0:
+        return get_value(params[1], registers)
+    return offset + 3
+
+
+def op_jf(memory, stack, registers, offset, params, decoded):
+    """
+    "8 a b": jump to <b> if <a> == 0
+    """
+    if get_value(params[0], registers) == 0:
+        return get_value(params[1], registers)
+    return offset + 3
+
+
+def op_add(memory, stack, registers, offset, params, decoded):
+    """
+    "9 a b c": <a> = <b> + <c>, % 32768
+    """
+    res = (get_value(params[1], registers) + get_value(params[2], registers)) % 32768
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_mult(memory, stack, registers, offset, params, decoded):
+    """
+    "10 a b c": <a> = <b> * <c>, % 32768
+    """
+    res = (get_value(params[1], registers) * get_value(params[2], registers)) % 32768
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_mod(memory, stack, registers, offset, params, decoded):
+    """
+    "11 a b c": <a> = remainder <b> / <c>
+    """
+    res = get_value(params[1], registers) % get_value(params[2], registers)
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_and(memory, stack, registers, offset, params, decoded):
+    """
+    "12 a b c": <a> = <b> and <c>
+    """
+    res = get_value(params[1], registers) & get_value(params[2], registers)
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_or(memory, stack, registers, offset, params, decoded):
+    """
+    "13 a b c": <a> = <b> or <c>
+    """
+    res = get_value(params[1], registers) | get_value(params[2], registers)
+    set_value(res, params[0], registers, memory, decoded)
+    return offset + 4
+
+
+def op_not(memory, stack, registers, offset, params, decoded):
+    """
+    "14 a b": <a> = not <b> (bitwise inverse)
+    """
+    set_value(32767 - get_value(params[1], registers), params[0], registers, memory, decoded)
+    return offset + 3
+
+
+def op_rmem(memory, stack, registers, offset, params, decoded):
+    """
+    "15 a b": read memory address <b> and write it to <a>
+    """
+    set_value(load_value(params[1], memory, registers), params[0], registers, memory, decoded)
+    return offset + 3
+
+
+def op_wmem(memory, stack, registers, offset, params, decoded):
+    """
+    "16 a b": write the value from <b> into memory at address <a>
+    """
+    loc = params[0]
+    if loc > 32767:
+        loc = get_value(loc, registers)
+    set_value(get_value(params[1], registers), loc, registers, memory, decoded)
+    return offset + 3
+
+
+def op_call(memory, stack, registers, offset, params, decoded):
+    """
+    "17 a": Write address of next instruction to stack and jump to memory location <a>
+    """
+    stack.append(offset + 2)
+    return get_value(params[0], registers)
+
+
+def op_ret(memory, stack, registers, offset, params, decoded):
+    """
+    "18": remove element from stack and jump to it (empty stack = halt)
+    """
+    return stack.pop()
+
+
+def op_out(memory, stack, registers, offset, params, decoded):
+    """
+    "19 a": writes the ascii code at <a> to terminal
+    """
+    (decoded.stdout or sys.stdout).write(chr(get_value(params[0], registers)))
+    return offset + 2
+
+
+def op_in(memory, stack, registers, offset, params, decoded):
+    """
+    "20 a": read ascii character from terminal into <a>. Probably strung together ops to read a whole line.
+    """
+    set_value(ord((decoded.stdin or sys.stdin).read(1)), params[0], registers, memory, decoded)
+    return offset + 2
+
+
+def op_noop(memory, stack, registers, offset, params, decoded):
+    """
+    "21": No op
+    """
+    return offset + 1
+
+
+def op_intrinsic(memory, stack, registers, offset, params, decoded):
+    """
+    Runs the host function registered at this address instead of the guest routine, then returns like its 'ret' would.
+    """
+    decoded.intrinsics[offset](registers, stack, memory)
+    return stack.pop()
+
+
+def op_fused(memory, stack, registers, offset, params, decoded):
+    """
+    Runs a straight run of immediate 'out', 'noop' and 'set' to a constant fused into one (see DecodeCache.fuse).
+    params are the text the run prints, the (register, value) pairs it leaves set, and the offset just past it.
+    """
+    text, sets, next_offset = params
+    if text:
+        (decoded.stdout or sys.stdout).write(text)
+    for register, value in sets:
+        registers[register] = value
+    return next_offset
+
+
+def op_trap(memory, stack, registers, offset, params, decoded):
+    """
+    Stands in for an instruction the debugger is watching, letting it look (and maybe raise Break) before the
+    instruction itself runs.
+    """
+    handler, params, op = decoded.decode(offset)
+    decoded.debugger.check(memory, stack, registers, offset, op, params)
+    return handler(memory, stack, registers, offset, params, decoded)
+
+
+handlers = [op_halt, op_set, op_push, op_pop, op_eq, op_gt, op_jmp, op_jt, op_jf, op_add, op_mult, op_mod, op_and,
+            op_or, op_not, op_rmem, op_wmem, op_call, op_ret, op_out, op_in, op_noop]
+
+
+class DecodeCache(dict):
+    """
+    Instructions decoded once and keyed by their address, as (handler, params, op) tuples. With specialize set, the
+    handler is made for that one instruction, with its operands already resolved (see specialized.py).
+    An address that isn't in the cache yet gets decoded from memory on first lookup.
+    Words covered by a decoded instruction are marked, so a write landing on one of them drops the stale entries.
+    It also carries the streams 'in' and 'out' use, falling back to sys.stdin and sys.stdout when they're None,
+    and the intrinsics registered by address. Those decode as a 'ret' that runs the host function first.
+    With a debugger attached, instructions it wants to look at decode as a trap that calls it first. Without one,
+    nothing changes, so breakpoints cost nothing until there are some.
+    With fuse set, straight runs of immediate 'out', 'noop' and 'set' to a constant decode as a single op_fused entry
+    at the start of the run. Those get turned off by anything that needs to see every instruction, like a journal.
+    """
+    def __init__(self, memory, stdin=None, stdout=None):
+        super().__init__()
+        self.memory = memory
+        self.covered = bytearray(32768)
+        self.stdin = stdin
+        self.stdout = stdout
+        self.intrinsics = {}
+        self.debugger = None
+        self.specialize = True
+        self.fuse = True
+        # Fused runs as {start: end}, and the words any of them cover, so a write into the middle of one drops it.
+        self.fused = {}
+        self.in_fused = bytearray(32768)
+        # The start of the run each instruction inside one belongs to, so those decode on their own instead of
+        # fusing the rest of the run all over again.
+        self.run_of = {}
+
+    def __missing__(self, offset):
+        entry = self.decode(offset)
+        if self.debugger is not None:
+            if self.debugger.traps(offset, entry[2], entry[1]):
+                entry = (op_trap, entry[1], entry[2])
+        elif self.fuse and entry[2] in (1, 19, 21) and not self.inside_run(offset):
+            entry = self.fuse_run(offset, entry)
+        self[offset] = entry
+        return entry
+
+    def decode(self, offset):
+        """
+        Decodes the instruction at offset, without any trap, and marks the words it covers.
+        """
+        op = self.memory[offset]
+        if offset in self.intrinsics:
+            num_params = 0
+            entry = (op_intrinsic, (), 18)
+        elif op > 21:  # Running into data halts, same as an unknown opcode always has.
+            num_params = 0
+            entry = (op_halt, (), op)
+        else:
+            num_params = param_lens[op]
+            params = tuple(self.memory[offset + 1 : offset + 1 + num_params])
+            entry = ((self.specialize and handler_for(op, params, offset)) or handlers[op], params, op)
+        end = min(offset + 1 + num_params, 32768)
+        self.covered[offset : end] = b'\x01' * (end - offset)
+        return entry
+
+    def inside_run(self, offset):
+        """
+        Returns whether offset is an instruction inside a fused run, past its first.
+        """
+        start = self.run_of.get(offset)
+        return start is not None and self.fused.get(start, 0) > offset
+
+    def fuse_run(self, offset, entry):
+        """
+        Fuses the run of immediate 'out', 'noop' and 'set' to a constant starting at offset into one op_fused entry.
+        Returns entry, the instruction at offset decoded on its own, if there's no run of at least two.
+        """
+        memory = self.memory
+        text = []
+        sets = {}
+        count = 0
+        address = offset
+        starts = []
+        while address < 32765 and address not in self.intrinsics:
+            op = memory[address]
+            if op == 19 and memory[address + 1] < 32768:
+                text.append(chr(memory[address + 1]))
+                address += 2
+            elif op == 21:
+                address += 1
+            elif op == 1 and 32767 < memory[address + 1] < 32776 and memory[address + 2] < 32768:
+                sets[memory[address + 1] - 32768] = memory[address + 2]
+                address += 3
+            else:
+                break
+            count += 1
+            starts.append(address)
+        if count < 2:
+            return entry
+        # Where each instruction after the first starts, the last one being the end of the run.
+        for start in starts[:-1]:
+            self.run_of[start] = offset
+        self.covered[offset : address] = b'\x01' * (address - offset)
+        self.in_fused[offset : address] = b'\x01' * (address - offset)
+        self.fused[offset] = address
+        return (op_fused, (''.join(text), tuple(sets.items()), address), FUSED)
+
+    def invalidate(self, location):
+        """
+        Drops any decoded instruction that the word at location is part of.
+        """
+        if self.covered[location]:
+            for start in range(location - 3, location + 1):
+                self.pop(start, None)
+            if self.in_fused[location]:
+                for start, end in list(self.fused.items()):
+                    if start <= location < end:
+                        self.pop(start, None)
+                        del self.fused[start]
+
+    def reset(self):
+        """
+        Drops everything decoded, for when memory has been replaced wholesale.
+        """
+        self.clear()
+        self.fused.clear()
+        self.in_fused[:] = bytes(32768)
+        self.run_of.clear()
+
+    def clone(self, memory):
+        """
+        Returns a copy of this cache for a copy of its memory, so a forked run doesn't decode everything again.
+        """
+        copy = type(self)(memory, self.stdin, self.stdout)
+        copy.update(self)
+        copy.covered[:] = self.covered
+        copy.intrinsics = dict(self.intrinsics)
+        copy.debugger = self.debugger
+        copy.specialize = self.specialize
+        copy.fuse = self.fuse
+        copy.fused = dict(self.fused)
+        copy.in_fused[:] = self.in_fused
+        copy.run_of = dict(self.run_of)
+        return copy
+
+    def add_intrinsic(self, address, function):
+        """
+        Runs function in place of the guest routine starting at address from now on.
+        """
+        self.intrinsics[address] = function
+        self.covered[address] = 1
+        self.invalidate(address)
+
+    def remove_intrinsic(self, address):
+        """
+        Goes back to running the guest routine at address.
+        """
+        self.intrinsics.pop(address, None)
+        self.covered[address] = 1
+        self.invalidate(address)
+
+
+def run_batch(memory, stack, registers, offset, decoded, count):
+    """
+    Runs up to count instructions straight from the decode cache, skipping all the per-tic checks run_inner makes.
+    Returns the offset to carry on from and whether the VM halted.
+    """
+    try:
+        for _ in range(count):
+            handler, params, op = decoded[offset]
+            next_offset = handler(memory, stack, registers, offset, params, decoded)
+            if next_offset == HALT:
+                return offset, True
+            offset = next_offset
+    # Only raised from a blocked 'in', so offset still points at it and it'll just be run again.
+    except Interrupted:
+        pass
+    except Stop as stop:
+        stop.offset = offset
+        raise
+    return offset, False
+
+
+def run_inner(memory, stack, registers, offset, tracer, breakpoint, decoded=None):
+    """
+    Takes care of running the VM for on 'tic', and records it in the trace if one is given.
+    The instruction at offset comes from the decode cache, which is built on the fly if not passed in.
+    """
+    if decoded is None:
+        decoded = DecodeCache(memory)
+    start_offset = offset
+
+    if breakpoint == offset:
+        raise Interrupted("breakpoint at offset: {}".format(offset))
+
+    handler, params, op = decoded[offset]
+    if tracer:
+        before = registers[:]
+    try:
+        offset = handler(memory, stack, registers, offset, params, decoded)
+    except Stop as stop:
+        stop.offset = offset
+        raise
+    halt = offset == HALT
+
+    if tracer:
+        tracer.record(start_offset, op, params, before, registers, stack)
+    return halt, memory, stack, registers, offset